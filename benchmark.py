@@ -0,0 +1,255 @@
+# Performance harness
+#
+#   python benchmark.py                          full suite, table on stdout
+#   python benchmark.py --quick --json run.json  small inputs only, results saved as JSON
+#   python benchmark.py --compare base.json      run again and flag regressions against base.json
+#   python benchmark.py --legacy                 the rgb split reference check
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from glitch_effect import ImageGlitcher, frame_seed
+
+RESOLUTIONS = ((256, 256), (640, 480), (1280, 720))
+
+# Synthetic inputs of the suite, from a thumbnail up to 4K
+SUITE_RESOLUTIONS = ((256, 256), (640, 480), (1280, 720), (1920, 1080), (3840, 2160))
+QUICK_RESOLUTIONS = ((256, 256), (1280, 720))
+
+# Every single effect plus stacks that are used together in practice
+STACKS = tuple((i,) for i in range(11)) + (
+    (1, 5, 8),                      # fused geometric effects only
+    (2, 6, 3),                      # remaps around a block barrier
+    (0, 1, 10),                     # noise, split and color blocks
+    (1, 4, 5, 8, 9),                # long fused remap chain
+    tuple(range(11)),               # everything
+)
+
+# A run is flagged when its median is this much slower than the baseline
+REGRESSION_THRESHOLD = 0.10
+
+
+def legacy_rgb_split(arr, x_offset, y_offset):
+    """
+     The original per-pixel rgb split, kept as the reference for the vectorized one
+    """
+    height, width = arr.shape[:2]
+
+    def clamp_int(x, max_, min_=0):
+        if x < min_:
+            return int(min_)
+        elif x > max_:
+            return int(max_)
+        else:
+            return int(x)
+
+    frame = arr.copy()
+    for y in range(height):
+        for x in range(width):
+            frame[y][x][0] = arr[clamp_int(y + y_offset, height - 1)][clamp_int(x + x_offset, width - 1)][0]
+            frame[y][x][2] = arr[clamp_int(y - y_offset, height - 1)][clamp_int(x - x_offset, width - 1)][2]
+    return frame
+
+
+def synthetic_image(width, height, mode='RGB'):
+    rng = np.random.RandomState(width * height)
+    arr = rng.randint(0, 256, size=(height, width, len(mode)), dtype=np.uint8)
+    return Image.fromarray(arr, mode)
+
+
+def bench_rgb_split(resolutions=RESOLUTIONS, seed=1, repeat=3):
+    """
+     Times the legacy loop against the vectorized rgb split for each resolution
+     and checks that both give the same pixels for the same drawn offsets
+    """
+    glitcher = ImageGlitcher()
+    for width, height in resolutions:
+        img = synthetic_image(width, height)
+        arr = np.asarray(img)
+
+        # Draw the offsets exactly like __rgb_split does for the first frame
+        random.seed(frame_seed(seed, 0))
+        x_offset = random.normalvariate(0, 0.01) * width
+        y_offset = random.normalvariate(0, 0.01) * height
+
+        start = time.perf_counter()
+        expected = legacy_rgb_split(arr, x_offset, y_offset)
+        legacy_time = time.perf_counter() - start
+
+        vectorized_time = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = glitcher.glitch_image(img, seed=seed, effect_type_seq=(1,))
+            vectorized_time = min(vectorized_time, time.perf_counter() - start)
+
+        identical = np.array_equal(np.asarray(result), expected)
+        print(f'rgb_split {width}x{height}: legacy {legacy_time * 1000:.1f} ms, '
+              f'vectorized {vectorized_time * 1000:.1f} ms, '
+              f'speedup {legacy_time / vectorized_time:.0f}x, identical = {identical}')
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its own high water mark, elsewhere the peak is for the whole run
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def suite_inputs(img_path='pics', resolutions=SUITE_RESOLUTIONS):
+    """
+     Yields (name, pixels) for the images in img_path and synthetic inputs of every resolution
+    """
+    if img_path and os.path.isdir(img_path):
+        for name in sorted(os.listdir(img_path)):
+            path = os.path.join(img_path, name)
+            if os.path.isfile(path) and not name.startswith('.'):
+                yield name, np.asarray(Image.open(path).convert('RGB'))
+    for width, height in resolutions:
+        yield f'synthetic_{width}x{height}', np.asarray(synthetic_image(width, height))
+
+
+def time_stack(glitcher, arr, effect_type_seq, repeat=5, seed=1):
+    """
+     Renders repeat frames of arr after one warm-up frame and returns the wall times in seconds
+     Every frame has its own index, so the timings cover different random draws
+    """
+    glitcher.glitch_array(arr, 0, effect_type_seq, seed=seed)
+    times = []
+    for frame_index in range(1, repeat + 1):
+        start = time.perf_counter()
+        glitcher.glitch_array(arr, frame_index, effect_type_seq, seed=seed)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_suite(inputs, stacks=STACKS, repeat=5, seed=1, log=sys.stdout, threads=1):
+    """
+     Times every stack on every input, rendering every frame with threads threads
+     Returns the results as a JSON serializable dict, one entry per (input, stack)
+    """
+    glitcher = ImageGlitcher(threads=threads)
+    results = []
+    for name, arr in inputs:
+        for effect_type_seq in stacks:
+            reset_peak_rss()
+            times = np.array(time_stack(glitcher, arr, effect_type_seq, repeat, seed))
+            median = float(np.median(times))
+            entry = {
+                'input': name,
+                'size': [int(arr.shape[1]), int(arr.shape[0])],
+                'effects': list(effect_type_seq),
+                'median_ms': median * 1000,
+                'p95_ms': float(np.percentile(times, 95)) * 1000,
+                'fps': 1 / median if median else float('inf'),
+                'peak_rss_mb': peak_rss_mb(),
+            }
+            results.append(entry)
+            print(f"{name:>28} {','.join(map(str, effect_type_seq)):>22}: "
+                  f"median {entry['median_ms']:8.1f} ms, p95 {entry['p95_ms']:8.1f} ms, "
+                  f"{entry['fps']:7.1f} fps, peak rss {entry['peak_rss_mb']:7.0f} MB", file=log, flush=True)
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pillow': Image.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'threads': threads,
+            'repeat': repeat,
+            'seed': seed,
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD, log=sys.stdout):
+    """
+     Compares the medians of two suite runs and returns the regressed entries,
+     runs slower than the baseline by more than threshold (a fraction)
+    """
+    def key(entry):
+        return entry['input'], tuple(entry['size']), tuple(entry['effects'])
+
+    base = {key(entry): entry for entry in baseline['results']}
+    regressions = []
+    for entry in results['results']:
+        old = base.get(key(entry))
+        if old is None:
+            continue
+        change = entry['median_ms'] / old['median_ms'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(dict(entry, baseline_median_ms=old['median_ms'], change=change))
+        print(f"{entry['input']:>28} {','.join(map(str, entry['effects'])):>22}: "
+              f"{old['median_ms']:8.1f} -> {entry['median_ms']:8.1f} ms ({change:+.1%}){flag}", file=log)
+    print(f'{len(regressions)} regression(s) over {threshold:.0%}', file=log)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the glitch effects')
+    parser.add_argument('--quick', action='store_true', help='synthetic 256px and 720p inputs only')
+    parser.add_argument('--images', default='pics', help='directory of real images, empty to skip')
+    parser.add_argument('--effects', nargs='+', help='stacks to run, e.g. 1 1,5,8 (defaults to all)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed frames per stack')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=1, help='threads every frame is rendered with')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline JSON to flag regressions against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='slowdown of the median that counts as a regression, as a fraction')
+    parser.add_argument('--legacy', action='store_true', help='run the rgb split reference check only')
+    args = parser.parse_args(argv)
+
+    if args.legacy:
+        bench_rgb_split()
+        return 0
+
+    stacks = STACKS
+    if args.effects:
+        stacks = tuple(tuple(int(i) for i in stack.split(',')) for stack in args.effects)
+    if args.quick:
+        inputs = suite_inputs(None, QUICK_RESOLUTIONS)
+    else:
+        inputs = suite_inputs(args.images, SUITE_RESOLUTIONS)
+
+    results = run_suite(inputs, stacks, args.repeat, args.seed, threads=args.threads)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
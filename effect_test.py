@@ -1,27 +1,17 @@
+# Smoke run of every effect on one of the sample images, the results are saved to
+# test_result/ for a visual check. Timings are measured by benchmark.py
 import os
-import random
-import shutil
-from decimal import getcontext, Decimal
-from typing import List, Optional, Tuple, Union
-import numpy
 
-import numpy as np
-from PIL import Image, ImageSequence, ImageDraw
+from glitch_effect import ImageGlitcher
 
+SOURCE = os.path.join('pics', 'USC_dornsife.jpg')
+OUT_DIR = 'test_result'
 
-def clamp(x, max, min=0):
-    if x < min:
-        return min
-    elif x > max:
-        return max
-    else:
-        return x
 
-
-image = Image.open('pics/source.png')
-assert isinstance(image, Image.Image)
-
-
-
-
-image.save('test_result/test_output.png')
+if __name__ == '__main__':
+    os.makedirs(OUT_DIR, exist_ok=True)
+    glitcher = ImageGlitcher()
+    for effect_i in range(len(glitcher.effects)):
+        image = glitcher.glitch_image(SOURCE, seed=1, effect_type_seq=(effect_i,))
+        image.save(os.path.join(OUT_DIR, 'test_output_' + str(effect_i) + '.png'))
+        print('saved effect', effect_i)
@@ -0,0 +1,396 @@
+# Streaming GIF and APNG writers
+# Every frame is encoded and written as soon as it is passed in, so only one frame
+# has to be in memory, however long the animation is
+
+import io
+import struct
+import zlib
+from functools import lru_cache
+from typing import BinaryIO, Iterable, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+# Index of the transparent color of the global palette, the others hold the source colors
+TRANSPARENT_INDEX = 255
+# Bits per channel the RGB -> index lookup table is addressed with
+LUT_BITS = 6
+
+
+def global_palette(image: Union[Image.Image, np.ndarray], colors: int = 255) -> np.ndarray:
+    """
+     Median cut palette of at most colors (<= 255) entries of image, as a (n, 3) uint8 array
+     Large images are reduced first, the palette does not get better from every pixel
+    """
+    if not 0 < colors <= TRANSPARENT_INDEX:
+        raise ValueError(f'colors param must be in [1, {TRANSPARENT_INDEX}]')
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image, 'RGB' if image.shape[2] == 3 else 'RGBA')
+    image = image.convert('RGB')
+    image.thumbnail((512, 512))
+    quantized = image.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+    return np.array(quantized.getpalette(), dtype=np.uint8).reshape(-1, 3)[:colors]
+
+
+def palette_lut(palette: np.ndarray) -> np.ndarray:
+    """
+     Table of the nearest palette entry of every color, addressed by the top LUT_BITS bits
+     of r, g and b: lut[(r >> 2) << 12 | (g >> 2) << 6 | b >> 2] for 6 bits
+     Tables of the last few palettes are kept, writers of the same source share them
+    """
+    return _palette_lut(np.ascontiguousarray(palette, dtype=np.uint8).tobytes())
+
+
+@lru_cache(maxsize=8)
+def _palette_lut(palette_bytes: bytes) -> np.ndarray:
+    palette = np.frombuffer(palette_bytes, dtype=np.uint8).reshape(-1, 3)
+    levels = 1 << LUT_BITS
+    shift = 8 - LUT_BITS
+    # Center of the cell of colors that share an address
+    centers = (np.arange(levels, dtype=np.float32) * (1 << shift)) + ((1 << shift) - 1) / 2
+    r, g, b = np.meshgrid(centers, centers, centers, indexing='ij')
+    cells = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+
+    entries = palette.astype(np.float32)
+    # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, |c|^2 is the same for every entry so it is left out
+    norms = (entries ** 2).sum(axis=1)
+    lut = np.empty(len(cells), dtype=np.uint8)
+    chunk = 1 << 15
+    for start in range(0, len(cells), chunk):
+        distances = norms - 2 * cells[start:start + chunk] @ entries.T
+        lut[start:start + chunk] = distances.argmin(axis=1)
+    lut.flags.writeable = False
+    return lut
+
+
+class GifWriter:
+    """
+     Writes an animated GIF frame by frame
+     Without a palette, every frame is quantized to its own local palette by Pillow, like
+     save(append_images=...) does
+     palette: Image (usually the glitch source) or (n, 3) palette array to map all frames to
+              one global palette instead. Frames then only store the rectangle of the pixels
+              that changed since the previous frame, the other pixels of that rectangle are
+              transparent, which also compresses much better
+    """
+
+    def __init__(self, fp: Union[str, BinaryIO], duration=200, loop=0,
+                 palette: Optional[Union[Image.Image, np.ndarray]] = None):
+        self.own_fp = isinstance(fp, str)
+        self.fp = open(fp, 'wb') if self.own_fp else fp
+        self.duration = duration
+        self.loop = loop
+        self.size = None
+        self.palette = None
+        self.__lut = None
+        if palette is not None:
+            if isinstance(palette, Image.Image) or palette.ndim == 3:
+                palette = global_palette(palette)
+            self.palette = palette
+            self.__lut = palette_lut(palette)
+        # Indices on screen before the pending frame is drawn, and the frame itself,
+        # which is only written once the next frame tells how it has to be disposed
+        self.__canvas = None
+        self.__pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __write_header(self, size):
+        self.size = size
+        width, height = size
+        if self.palette is None:
+            # Logical screen without a global color table, every frame brings its own
+            self.fp.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0))
+        else:
+            # Global color table of 256 entries, the background is the transparent index
+            color_table = np.zeros((256, 3), dtype=np.uint8)
+            color_table[:len(self.palette)] = self.palette
+            self.fp.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0xf7, TRANSPARENT_INDEX, 0))
+            self.fp.write(color_table.tobytes())
+        if self.loop is not None:
+            # NETSCAPE2.0 application extension with the loop count
+            self.fp.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', self.loop) + b'\x00')
+
+    @staticmethod
+    def __encode(image: Image.Image, **params):
+        """
+         Encodes a single image with Pillow and returns its color table, interlace flag,
+         transparent index (None if it has none) and the image data blocks (LZW minimum
+         code size and data sub-blocks)
+        """
+        buffer = io.BytesIO()
+        image.save(buffer, format='GIF', **params)
+        data = buffer.getvalue()
+
+        flags = data[10]
+        pos = 13
+        color_table = b''
+        if flags & 0x80:
+            table_len = 3 << ((flags & 7) + 1)
+            color_table = data[pos:pos + table_len]
+            pos += table_len
+
+        # Skip the extensions in front of the image descriptor, except for the transparent
+        # index of the graphic control extension
+        transparency = None
+        while data[pos] == 0x21:
+            if data[pos + 1] == 0xf9 and data[pos + 3] & 1:
+                transparency = data[pos + 6]
+            pos += 2
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+
+        image_flags = data[pos + 9]
+        pos += 10
+        if image_flags & 0x80:
+            table_len = 3 << ((image_flags & 7) + 1)
+            color_table = data[pos:pos + table_len]
+            pos += table_len
+
+        # LZW minimum code size followed by the sub-blocks up to the terminator
+        start = pos
+        pos += 1
+        while data[pos]:
+            pos += data[pos] + 1
+        return color_table, image_flags & 0x40, transparency, data[start:pos + 1]
+
+    def write(self, image: Image.Image, duration: Optional[int] = None,
+              offset=(0, 0), disposal=0, transparency: Optional[int] = None):
+        """
+         Appends a frame, images smaller than the animation are placed at offset
+         duration is in milliseconds, defaults to the writer duration
+         transparency defaults to the transparent index Pillow encoded the image with, frames
+         with transparent pixels are then disposed to the background (2) instead of disposal
+        """
+        if self.size is None:
+            self.__write_header(image.size)
+        if duration is None:
+            duration = self.duration
+        if self.palette is not None:
+            if image.size != self.size:
+                raise ValueError('With a global palette all GIF frames must have the size of the first one')
+            self.__write_indexed(self.__indices(image), duration)
+            return
+
+        color_table, interlace, encoded_transparency, image_data = self.__encode(image)
+        if transparency is None and encoded_transparency is not None:
+            transparency = encoded_transparency
+            # Otherwise the previous frame would show through the transparent pixels
+            if disposal == 0:
+                disposal = 2
+        self.__write_frame(color_table, interlace, image_data, image.size, duration, offset, disposal, transparency)
+
+    def __write_frame(self, color_table, interlace, image_data, size, duration, offset, disposal, transparency):
+        # Graphic control extension with the frame delay in 1/100 s
+        packed = disposal << 2 | (transparency is not None)
+        self.fp.write(b'\x21\xf9\x04' + struct.pack('<BHB', packed, int(round(duration / 10)),
+                                                     transparency or 0) + b'\x00')
+
+        # Image descriptor with the color table of the frame as its local table, if it has one
+        flags = interlace
+        if color_table:
+            flags |= 0x80 | max((len(color_table) // 3 - 1).bit_length() - 1, 0)
+        left, top = offset
+        width, height = size
+        self.fp.write(b'\x2c' + struct.pack('<HHHHB', left, top, width, height, flags))
+        self.fp.write(color_table)
+        self.fp.write(image_data)
+
+    def __indices(self, image: Image.Image) -> np.ndarray:
+        # Global palette indices of the pixels, looked up by their top LUT_BITS bits
+        pixels = np.asarray(image)
+        shift = 8 - LUT_BITS
+        address = (pixels[..., 0] >> shift).astype(np.uint32)
+        address <<= LUT_BITS
+        address |= pixels[..., 1] >> shift
+        address <<= LUT_BITS
+        address |= pixels[..., 2] >> shift
+        indices = self.__lut[address]
+        if image.mode == 'RGBA':
+            indices[pixels[..., 3] < 128] = TRANSPARENT_INDEX
+        return indices
+
+    def __write_indexed(self, indices: np.ndarray, duration):
+        if self.__canvas is None:
+            # Nothing is drawn on the logical screen yet
+            self.__canvas = np.full_like(indices, TRANSPARENT_INDEX)
+        if self.__pending is not None:
+            # A pixel that turns transparent cannot be drawn over the previous frame, the
+            # previous frame then has to be restored to the (transparent) background
+            pending = self.__pending[0]
+            clear = np.any((pending != TRANSPARENT_INDEX) & (indices == TRANSPARENT_INDEX))
+            self.__flush(clear)
+        self.__pending = (indices, duration)
+
+    def __flush(self, clear: bool):
+        indices, duration = self.__pending
+        changed = indices != self.__canvas
+        if clear:
+            # The rectangle must cover every visible pixel, as only it is restored
+            changed |= indices != TRANSPARENT_INDEX
+        rows = np.flatnonzero(changed.any(axis=1))
+        if len(rows):
+            cols = np.flatnonzero(changed.any(axis=0))
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        else:
+            # Nothing changed, a single transparent pixel still carries the delay
+            top, bottom, left, right = 0, 1, 0, 1
+
+        # Pixels that are already on screen are left transparent
+        rect = np.where(changed[top:bottom, left:right], indices[top:bottom, left:right], TRANSPARENT_INDEX)
+        rect = Image.fromarray(np.ascontiguousarray(rect, dtype=np.uint8), 'P')
+        # Without optimize, Pillow could renumber the indices of small frames
+        _, interlace, _, image_data = self.__encode(rect, optimize=False)
+        # Disposal 1 keeps the frame on screen under the next one, 2 restores the background
+        self.__write_frame(b'', interlace, image_data, rect.size, duration, (int(left), int(top)),
+                           2 if clear else 1, TRANSPARENT_INDEX)
+
+        if clear:
+            self.__canvas[...] = TRANSPARENT_INDEX
+        else:
+            self.__canvas = indices
+        self.__pending = None
+
+    def close(self):
+        if self.fp is None:
+            return
+        if self.__pending is not None:
+            self.__flush(False)
+        # GIF trailer
+        self.fp.write(b'\x3b')
+        if self.own_fp:
+            self.fp.close()
+        self.fp = None
+
+
+class ApngWriter:
+    """
+     Writes an animated PNG frame by frame
+     The number of frames goes in front of the first frame, so it must be given up front
+     unless the file is seekable, in which case it is patched on close
+    """
+
+    def __init__(self, fp: Union[str, BinaryIO], duration=200, loop=0,
+                 frames: Optional[int] = None, compress_level=3):
+        self.own_fp = isinstance(fp, str)
+        self.fp = open(fp, 'wb') if self.own_fp else fp
+        self.duration = duration
+        self.loop = loop
+        self.frames = frames
+        self.compress_level = compress_level
+        self.size = None
+        self.mode = None
+        self.sequence = 0
+        self.written = 0
+        self.actl_pos = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __chunk(self, chunk_type: bytes, data: bytes):
+        self.fp.write(struct.pack('>I', len(data)) + chunk_type + data +
+                      struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def __write_header(self, image: Image.Image):
+        if image.mode not in ('RGB', 'RGBA'):
+            raise ValueError('APNG frames must be RGB or RGBA images')
+        self.size = image.size
+        self.mode = image.mode
+        width, height = image.size
+
+        self.fp.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bit truecolor (2) or truecolor with alpha (6)
+        color_type = 2 if image.mode == 'RGB' else 6
+        self.__chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+        if self.frames is None:
+            self.actl_pos = self.fp.tell()
+        self.__chunk(b'acTL', struct.pack('>II', self.frames or 0, self.loop))
+
+    def write(self, image: Image.Image, duration: Optional[int] = None):
+        """
+         Appends a frame, duration is in milliseconds, defaults to the writer duration
+        """
+        if self.size is None:
+            self.__write_header(image)
+        if image.size != self.size or image.mode != self.mode:
+            raise ValueError('All APNG frames must have the size and mode of the first one')
+        if duration is None:
+            duration = self.duration
+
+        width, height = self.size
+        self.__chunk(b'fcTL', struct.pack('>IIIIIHHBB', self.sequence, width, height, 0, 0,
+                                          int(duration), 1000, 0, 0))
+        self.sequence += 1
+
+        # Every scanline starts with its filter type, 0 means no filtering
+        pixels = np.asarray(image).reshape(height, -1)
+        scanlines = np.zeros((height, pixels.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 1:] = pixels
+        data = zlib.compress(scanlines.tobytes(), self.compress_level)
+
+        if self.written == 0:
+            # The first frame is also the default image
+            self.__chunk(b'IDAT', data)
+        else:
+            self.__chunk(b'fdAT', struct.pack('>I', self.sequence) + data)
+            self.sequence += 1
+        self.written += 1
+
+    def close(self):
+        if self.fp is None:
+            return
+        self.__chunk(b'IEND', b'')
+        if self.actl_pos is not None:
+            # Patch the real number of frames into acTL
+            end = self.fp.tell()
+            self.fp.seek(self.actl_pos)
+            self.__chunk(b'acTL', struct.pack('>II', self.written, self.loop))
+            self.fp.seek(end)
+        if self.own_fp:
+            self.fp.close()
+        self.fp = None
+        if self.frames is not None and self.frames != self.written:
+            raise ValueError(f'{self.written} frames written, {self.frames} expected')
+
+
+def open_writer(path: str, duration=200, loop=0, frames: Optional[int] = None,
+                palette: Optional[Union[Image.Image, np.ndarray]] = None):
+    # APNG for .png/.apng paths, GIF otherwise, APNG frames are not palettized
+    if path.lower().endswith(('.png', '.apng')):
+        return ApngWriter(path, duration=duration, loop=loop, frames=frames)
+    return GifWriter(path, duration=duration, loop=loop, palette=palette)
+
+
+def write_frames(frames: Iterable[Union[Image.Image, np.ndarray, Tuple[Image.Image, int]]], path: str,
+                 duration=200, loop=0, stats=None, palette: Optional[Union[Image.Image, np.ndarray]] = None):
+    """
+     Streams frames, e.g. from ImageGlitcher.iter_glitch_frames or the rows of the array
+     from ImageGlitcher.glitch_frames_array, into a GIF or APNG file
+     Frames may also be (Image, duration) pairs, e.g. from ImageGlitcher.iter_glitch_animation,
+     to keep the timing of every frame
+     stats: Optional GlitchStats to record the encode time of every frame in
+     palette: Source image (or palette) of the global GIF palette, see GifWriter
+    """
+    with open_writer(path, duration=duration, loop=loop, palette=palette) as writer:
+        for frame in frames:
+            if isinstance(frame, tuple):
+                frame, frame_duration = frame
+            else:
+                frame_duration = None
+            if isinstance(frame, np.ndarray):
+                # Frames of a (frames, height, width, channels) array from glitch_frames_array
+                frame = Image.fromarray(frame, 'RGB' if frame.shape[2] == 3 else 'RGBA')
+            if stats is None:
+                writer.write(frame, frame_duration)
+            else:
+                token = stats.begin()
+                writer.write(frame, frame_duration)
+                stats.end('encode', token, 'encode')
@@ -3,38 +3,113 @@
 import math
 import os
 import random
+import struct
 # The shutil module offers a number of high-level operations on files and collections of files.
 # In particular, functions are provided which support file copying and removal.
 import shutil
+import tempfile
+import weakref
+from contextlib import nullcontext
 # Decimal fixed point and floating point arithmetic
 # The decimal module provides support for fast correctly-rounded decimal floating point arithmetic.
 # It offers several advantages over the float datatype:
 from decimal import getcontext
+# Process pool for rendering GIF frames in parallel, thread pool for the bands of one frame
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 # Support for type hints (Most fundamental: Any, Union, Tuple, Callable, TypeVar, and Generic).
-from typing import List, Optional, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
 import numpy
 import numpy as np
 # Pillow is the friendly fork of PIL (the Python Imaging Library).
-from PIL import Image, ImageSequence, ImageDraw
+from PIL import Image, ImageSequence
+
+from glitch_stats import GlitchStats
+from noise_engine import NoiseEngine
+
+# Index passed to frame_seed for the seed of the noise tile pool, no frame ever gets it
+NOISE_POOL_INDEX = 2 ** 64 - 1
+
+# Longest side of the proxy that previews are rendered at
+PREVIEW_SIZE = 512
+# Number of decoded preview proxies a glitcher keeps
+PROXY_CACHE_SIZE = 4
+
+# Fewest rows of a band when a frame is split up between threads
+MIN_BAND_ROWS = 32
+
+# Names of ImageGlitcher.effects, in the same order
+EFFECT_NAMES = ('analog_noise', 'rgb_split', 'tile_jitter', 'screen_jump', 'screen_shake', 'wave_jitter',
+                'image_block', 'image_block_hsv', 'scan_line', 'line_block', 'color_block')
+
+
+def frame_seed(seed: Union[int, float], frame_index: int) -> int:
+    """
+     Seed of a single frame, derived only from the base seed and the frame index
+     so that every frame can be rendered on its own, in any order or process
+    """
+    if isinstance(seed, float):
+        seed = int.from_bytes(struct.pack('<d', seed), 'little')
+    return int(np.random.SeedSequence([seed % 2 ** 64, frame_index]).generate_state(1)[0])
 
 
 class ImageGlitcher:
 
-    def __init__(self):
+    def __init__(self, workspace: bool = False, noise_tiles: int = 0,
+                 stats: Optional[GlitchStats] = None, threads: int = 1):
+        """
+         Glitching happens entirely in memory, construction touches no files
+         workspace: Set True to get a private temp directory in gif_dirpath for spilling
+                    to disk, removed again by close() or when the glitcher is collected
+         noise_tiles: Size of the pre-generated tile pool that analog noise samples from,
+                      defaults to 0 (exact noise drawn for every frame)
+         stats: GlitchStats to record the time of every effect, decode and copy in,
+                defaults to None (no instrumentation). Frames rendered by worker
+                processes are not recorded, every worker has a glitcher of its own
+         threads: Number of threads every frame is rendered with, defaults to 1
+                  Every effect is split into bands of rows that are rendered at the same
+                  time, its random values are drawn before the bands start, so the result
+                  does not depend on the number of threads
+        """
+        if not (isinstance(threads, int) and threads > 0):
+            raise ValueError('threads param must be a positive integer value greater than 0')
         # Setting up global variables needed for glitching
         self.pixel_tuple_len = 0
         self.img_width, self.img_height = 0, 0
         self.img_mode = 'Unknown'
         self.seed = None
+        # Seed that the per frame seeds are derived from, drawn at random if no seed is given
+        self.__base_seed = None
+        # Index of the frame being rendered, drives the scan line and screen jump phase
+        self.__frame_index = 0
+        # Random streams of the frame being rendered, all seeded from the frame seed
+        # They belong to the glitcher, so glitchers in different threads do not share any
+        self.__random = random.Random()
+        self.__np_random = np.random.RandomState()
+        self.__rng = None
+        self.__noise = NoiseEngine(tiles=noise_tiles)
+        self.stats = stats
+        self.threads = threads
+        # Created on first use, and again in a forked process, which does not get the threads
+        self.__thread_pool = None
+        self.__thread_pool_pid = None
+        # Resolution of the image being glitched relative to the full resolution source,
+        # effect parameters given in pixels are scaled by it, so previews look like the final render
+        self.scale = 1.0
+        # (path, mtime, max_size) -> (proxy pixels, scale) of the recent previews
+        self.__proxies = {}
+
+        # Alpha composite lookup tables of color block, by fill value
+        self.__composite_tables = {}
 
         # Creating 3D arrays for pixel data
         self.inputarr = None
         self.outputarr = None
+        # Two reusable frame buffers, effects read from one and write into the other
+        self.__buffers = ()
 
-        # Getting path of temp folders
-        self.lib_path = os.path.split(os.path.abspath(__file__))[0]  # get parent dir
-        self.gif_dirpath = os.path.join(self.lib_path, 'Glitched GIF')
+        # Path of the per instance temp folder, None when working in memory only
+        self.gif_dirpath = None
 
         # Setting glitch_amount max and min
         self.GLITCH_MAX = 10.0
@@ -54,14 +129,47 @@ class ImageGlitcher:
             self.__color_block,
         )
 
-        self.__scan_line_current_step = 0
-
-        # Return glitched GIF
-        # Set up directory for storing glitched images
-        # code moved to init for optimization
-        if os.path.isdir(self.gif_dirpath):
-            shutil.rmtree(self.gif_dirpath)
-        os.mkdir(self.gif_dirpath)
+        # Effects that only move pixels around, consecutive ones are fused into one remap
+        self.remap_effects = {
+            self.__rgb_split: self.__rgb_split_remap,
+            self.__tile_jitter: self.__tile_jitter_remap,
+            self.__screen_jump: self.__screen_jump_remap,
+            self.__screen_shake: self.__screen_shake_remap,
+            self.__wave_jitter: self.__wave_jitter_remap,
+            self.__scan_line: self.__scan_line_remap,
+            self.__line_block: self.__line_block_remap,
+        }
+
+        # Builders of all other effects, they draw the random values of one frame and return
+        # apply(src, dst, row_start, row_stop), which renders rows [row_start, row_stop)
+        # of the result from the whole src into dst
+        self.band_effects = {
+            self.__analog_noise: self.__analog_noise_bands,
+            self.__image_block: self.__image_block_bands,
+            self.__image_block_hsv: self.__image_block_hsv_bands,
+            self.__color_block: self.__color_block_bands,
+        }
+        if workspace:
+            # Unique per instance, so concurrent glitchers never touch each other's files
+            self.gif_dirpath = tempfile.mkdtemp(prefix='glitch_')
+            weakref.finalize(self, shutil.rmtree, self.gif_dirpath, True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+         Removes the temp workspace, if there is one, and stops the band threads
+        """
+        if self.__thread_pool is not None:
+            self.__thread_pool.shutdown()
+            self.__thread_pool = None
+        if self.gif_dirpath is not None:
+            shutil.rmtree(self.gif_dirpath, ignore_errors=True)
+            self.gif_dirpath = None
 
     # Returns true if input image is a GIF and/or animated
     @staticmethod
@@ -83,8 +191,9 @@ class ImageGlitcher:
     def __open_image(img_path: str) -> Image.Image:
         # Will throw exception if img_path doesn't point to Image
         if img_path.endswith('.gif'):
-            # Do not convert GIF file
-            return Image.open(img_path)
+            # Palette GIF to RGB, or RGBA if it has a transparent color
+            img = Image.open(img_path)
+            return img.convert('RGBA' if 'transparency' in img.info else 'RGB')
         elif img_path.endswith('.png'):
             # Convert the Image to RGBA if it's png
             return Image.open(img_path).convert('RGBA')
@@ -125,8 +234,9 @@ class ImageGlitcher:
              If GIF is allowed, any Image object is good to go
             """
             if src_img.format == 'GIF':
-                # Do not convert GIF file
-                return src_img
+                # Palette GIF to RGB, or RGBA if it has a transparent color, the effects need
+                # channels instead of palette indices
+                img = src_img.convert('RGBA' if 'transparency' in src_img.info else 'RGB')
             elif src_img.format == 'PNG':
                 # Convert the Image to RGBA if it's png
                 img = src_img.convert('RGBA')
@@ -142,21 +252,23 @@ class ImageGlitcher:
         return img
 
     def glitch_image(self,
-                     src_img: Union[str, Image.Image],
+                     src_img: Union[str, Image.Image, np.ndarray],
                      seed: Optional[Union[int, float]] = None,
                      glitch_change: Union[int, float] = 0.0,
                      gif: bool = False,
                      cycle: bool = False,
                      frames: int = 23,
                      step: int = 1,
-                     effect_type_seq=()
+                     effect_type_seq=(),
+                     workers: int = 1
                      ) -> Union[Image.Image, List[Image.Image]]:
         """
          Sets up values needed for glitching the image
          Returns created Image object if gif=False
          Returns list of Image objects if gif=True
          PARAMETERS:-
-         src_img: Either the path to input Image or an Image object itself
+         src_img: Either the path to input Image, an Image object itself
+                  or an (height, width, 3 or 4) uint8 array of RGB or RGBA pixels
          glitch_amount: Level of glitch intensity, [0.1, 10.0] (inclusive)
          glitch_change: Increment/Decrement in glitch_amount after every glitch
          cycle: Whether or not to cycle glitch_amount back to glitch_min or glitch_max
@@ -168,6 +280,10 @@ class ImageGlitcher:
          step: Glitch every step'th frame, defaults to 1 (i.e all frames)
          seed: Set a random seed for generating similar images across runs,
                defaults to None (random seed).
+               Every frame is seeded from this seed and its index.
+         workers: Number of processes rendering GIF frames, defaults to 1 (no pool).
+                  The frames do not depend on the number of workers, every worker builds a
+                  single threaded glitcher of its own from the source pixels and the seed.
         """
 
         # Sanity checking the inputs
@@ -176,113 +292,603 @@ class ImageGlitcher:
                 and -self.GLITCH_MAX <= glitch_change <= self.GLITCH_MAX):
             raise ValueError(
                 f'glitch_change parameter must be a number between {-self.GLITCH_MAX} and {self.GLITCH_MAX}, inclusive')
-        if seed and not (isinstance(seed, float) or isinstance(seed, int)):
-            raise ValueError(
-                f'seed parameter must be a number')
-        if not (frames > 0 and isinstance(frames, int)):
-            raise ValueError(
-                'frames param must be a positive integer value greater than 0')
-        if not step > 0 or not isinstance(step, int):
-            raise ValueError(
-                'step parameter must be a positive integer value greater than 0')
+        self.__check_frame_params(seed, frames, step)
         if not isinstance(cycle, bool):
             raise ValueError('cycle param must be a boolean')
         if not isinstance(gif, bool):
             raise ValueError('gif param must be a boolean')
+        if not (isinstance(workers, int) and workers > 0):
+            raise ValueError('workers param must be a positive integer value greater than 0')
 
-        self.seed = seed
-        if self.seed:
-            # Set the seed if it was given
-            self.__reset_seed()
-
-        try:
-            # Get Image, whether input was an str path or Image object
-            # GIF input is NOT allowed in this method
-            img = self.__fetch_image(src_img, gif_allowed=False)
-        except FileNotFoundError:
-            # Throw DETAILED exception here (Traceback will be present from previous exceptions)
-            raise FileNotFoundError(f'No image found at given path: {src_img}')
-        except:
-            # Throw DETAILED exception here (Traceback will be present from previous exceptions)
-            raise Exception(
-                'File format not supported - must be a non-animated image file')
-
-        # Fetching image attributes
-        self.pixel_tuple_len = len(img.getbands())
-        self.img_width, self.img_height = img.size
-        self.img_mode = img.mode
-
-        # Assigning the 3D arrays with pixel data
-        self.inputarr = np.asarray(img)
-        self.outputarr = np.array(img)
+        job = self.stats.begin() if self.stats is not None else None
+        self.__load_image(src_img, seed)
 
         # Glitching begins here
         if not gif:
             # Return glitched image
-            return self.__apply_glitch(effect_type_seq)
+            glitched_img = self.render_frame(0, effect_type_seq)
+            if job is not None:
+                self.stats.end('glitch_image', job, 'job')
+            return glitched_img
 
         # Return glitched GIF
-        # Set up directory for storing glitched images
-        # code moved to init for optimization
-
         # Set up decimal precision for glitch_change
         original_prec = getcontext().prec
         getcontext().prec = 4
 
+        # Every frame only depends on its index, so they can be rendered by a pool of processes
+        rendered = {}
+        if workers > 1:
+            frame_indices = range(0, frames, step)
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_init_frame_worker,
+                                     initargs=self.__frame_worker_state() + (effect_type_seq,)) as pool:
+                rendered = dict(zip(frame_indices, pool.map(_render_frame_worker, frame_indices)))
+
         glitched_imgs = []
+        for i, glitched_img in enumerate(self.__iter_frames(frames, step, effect_type_seq, rendered)):
+            # Frames that are not glitched are appended as copies of the original
+            glitched_imgs.append(glitched_img.copy() if i % step else glitched_img)
+
+        # Set decimal precision back to original value
+        getcontext().prec = original_prec
+        if job is not None:
+            self.stats.end('glitch_image', job, 'job')
+        return glitched_imgs
+
+    def iter_glitch_frames(self,
+                           src_img: Union[str, Image.Image, np.ndarray],
+                           seed: Optional[Union[int, float]] = None,
+                           frames: int = 23,
+                           step: int = 1,
+                           effect_type_seq=()
+                           ) -> Iterator[Image.Image]:
+        """
+         Same frames as glitch_image(gif=True), but yielded one at a time as they are
+         rendered so only the current frame has to be kept in memory
+         Frames that are not glitched are the same original Image object
+         The glitcher renders one image at a time, do not interleave two of these iterators
+        """
+        self.__check_frame_params(seed, frames, step)
+        self.__load_image(src_img, seed)
+        return self.__iter_frames(frames, step, effect_type_seq)
+
+    def iter_preview_frames(self,
+                            src_img: Union[str, Image.Image, np.ndarray],
+                            seed: Optional[Union[int, float]] = None,
+                            frames: int = 23,
+                            step: int = 1,
+                            effect_type_seq=(),
+                            max_size: int = PREVIEW_SIZE
+                            ) -> Iterator[Image.Image]:
+        """
+         Low resolution version of iter_glitch_frames for tuning effects interactively
+         The source is reduced to fit in max_size x max_size, JPEGs are decoded at reduced
+         scale right away, and the proxy is kept for the next preview of the same file
+         Effect parameters in pixels are scaled down with the image, so the preview looks
+         like the full resolution render
+         Without a seed, one is drawn and kept in self.seed: pass it to glitch_image or
+         iter_glitch_frames to render the final output
+        """
+        self.__check_frame_params(seed, frames, step)
+        if not seed:
+            seed = random.SystemRandom().getrandbits(63)
+        proxy, scale = self.__proxy(src_img, max_size)
+        self.__load_image(proxy, seed)
+        # Until the next source is set up
+        self.scale = scale
+        return self.__iter_frames(frames, step, effect_type_seq)
+
+    def __proxy(self, src_img: Union[str, Image.Image, np.ndarray], max_size: int) -> Tuple[np.ndarray, float]:
+        """
+         Pixels of src_img reduced to fit in max_size x max_size, in the mode the full
+         image would be glitched in, and their scale relative to the full image
+        """
+        if not (isinstance(max_size, int) and max_size > 0):
+            raise ValueError('max_size param must be a positive integer value greater than 0')
+        key = None
+        if isinstance(src_img, str):
+            if not os.path.isfile(src_img):
+                raise FileNotFoundError(f'No image found at given path: {src_img}')
+            key = (os.path.abspath(src_img), os.stat(src_img).st_mtime_ns, max_size)
+            if key in self.__proxies:
+                return self.__proxies[key]
+            img = Image.open(src_img)
+            mode = 'RGBA' if src_img.endswith('.png') else 'RGB'
+        elif isinstance(src_img, Image.Image):
+            img = src_img
+            mode = 'RGBA' if src_img.format == 'PNG' else 'RGB'
+        else:
+            img = Image.fromarray(src_img, 'RGB' if src_img.shape[2] == 3 else 'RGBA')
+            mode = img.mode
+        if self.__is_gif(img):
+            raise Exception('File format not supported - must be a non-animated image file')
+
+        full_width, full_height = img.size
+        ratio = min(max_size / full_width, max_size / full_height, 1)
+        size = (max(1, round(full_width * ratio)), max(1, round(full_height * ratio)))
+        token = self.stats.begin() if self.stats is not None else None
+        if img.format == 'JPEG':
+            # DCT scaling, JPEGs are decoded at 1/2, 1/4 or 1/8 of their size, no smaller than size
+            img.draft(mode, size)
+        img = img.convert(mode)
+        factor = min(img.width // size[0], img.height // size[1])
+        if factor > 1:
+            img = img.reduce(factor)
+        if img.size != size:
+            img = img.resize(size, Image.BILINEAR)
+        if token is not None:
+            self.stats.end('decode_proxy', token, 'decode')
+
+        proxy = (np.asarray(img), size[0] / full_width)
+        if key is not None:
+            if len(self.__proxies) >= PROXY_CACHE_SIZE:
+                del self.__proxies[next(iter(self.__proxies))]
+            self.__proxies[key] = proxy
+        return proxy
+
+    def glitch_frames_array(self,
+                            src_img: Union[str, Image.Image, np.ndarray],
+                            seed: Optional[Union[int, float]] = None,
+                            frames: int = 23,
+                            step: int = 1,
+                            effect_type_seq=(),
+                            out: Optional[np.ndarray] = None
+                            ) -> np.ndarray:
+        """
+         Same frames as glitch_image(gif=True), stacked in one (frames, height, width, channels)
+         uint8 array
+         Every glitched frame is rendered straight into its slot of the array, no Image is
+         created and no frame is copied out of the buffers
+         out: Optional preallocated C-contiguous array of that shape to render into, e.g. reused
+              across calls
+        """
+        self.__check_frame_params(seed, frames, step)
+        self.__load_image(src_img, seed)
+
+        shape = (frames,) + self.inputarr.shape
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        elif not (isinstance(out, np.ndarray) and out.shape == shape and out.dtype == np.uint8
+                  and out.flags.c_contiguous):
+            raise ValueError(f'out must be a C-contiguous uint8 array of shape {shape}')
+
+        # Frames that are not glitched are the original, all filled in one assignment
+        if step > 1:
+            out[np.arange(frames) % step != 0] = self.inputarr
+        for i in range(0, frames, step):
+            self.__frame_index = i
+            self.__apply_effects(effect_type_seq, out[i])
+        return out
+
+    def __frame_worker_state(self):
+        # What a frame worker needs to render frames of the current source, all of it picklable
+        # The glitcher itself is not: its effect tables hold bound private methods
+        return self.inputarr, self.img_mode, self.seed, self.__base_seed, self.__noise.tiles, self.scale
+
+    @classmethod
+    def _for_frame_worker(cls, pixels, mode, seed, base_seed, noise_tiles, scale) -> 'ImageGlitcher':
+        """
+         Glitcher of a frame worker process, renders the same frames as the glitcher
+         the state was taken from
+        """
+        glitcher = cls(noise_tiles=noise_tiles)
+        glitcher.__set_pixels(pixels, mode)
+        glitcher.seed = seed
+        glitcher.__base_seed = base_seed
+        glitcher.scale = scale
+        return glitcher
+
+    def __iter_frames(self, frames, step, effect_type_seq, rendered=None):
+        # Image of the source, only made if some frames are not glitched
+        original = None
         for i in range(frames):
             """
              * Glitch the image for n times
              * Where n is 0,1,2...frames
-             * Save the image the in temp directory
-             * Open the image and append a copy of it to the list
             """
             if not i % step == 0:
                 # Only every step'th frame should be glitched
-                # Other frames will be appended as they are
-                glitched_imgs.append(img.copy())
-                continue
-            glitched_img = self.__apply_glitch(effect_type_seq)
-            file_path = os.path.join(self.gif_dirpath, 'glitched_frame.png')
-            # glitched_img.save(file_path, compress_level=3)
-            glitched_imgs.append(glitched_img.copy())
+                # Other frames are the original image
+                if original is None:
+                    original = Image.fromarray(self.inputarr, self.img_mode)
+                yield original
+            elif rendered and i in rendered:
+                yield rendered.pop(i)
+            else:
+                yield self.render_frame(i, effect_type_seq)
 
-        # Set decimal precision back to original value
-        getcontext().prec = original_prec
-        # Cleanup
-        shutil.rmtree(self.gif_dirpath)
-        return glitched_imgs
+    @staticmethod
+    def __check_frame_params(seed, frames, step):
+        if seed and not (isinstance(seed, float) or isinstance(seed, int)):
+            raise ValueError(
+                f'seed parameter must be a number')
+        if not (frames > 0 and isinstance(frames, int)):
+            raise ValueError(
+                'frames param must be a positive integer value greater than 0')
+        if not step > 0 or not isinstance(step, int):
+            raise ValueError(
+                'step parameter must be a positive integer value greater than 0')
 
-    def __apply_glitch(self, effect_type_seq=()) -> Image.Image:
+    def __load_image(self, src_img: Union[str, Image.Image, np.ndarray],
+                     seed: Optional[Union[int, float]]):
+        """
+         Opens the source image and sets up the seed, image attributes and frame buffers
+         Already decoded RGB or RGBA pixels, e.g. in shared memory, are glitched from where
+         they are, without a round trip through an Image
+        """
+        self.__set_seed(seed)
 
+        token = self.stats.begin() if self.stats is not None else None
+        if isinstance(src_img, np.ndarray) and src_img.dtype == np.uint8 \
+                and src_img.ndim == 3 and src_img.shape[2] in (3, 4):
+            self.__set_pixels(np.ascontiguousarray(src_img), 'RGB' if src_img.shape[2] == 3 else 'RGBA')
+        else:
+            try:
+                # Get Image, whether input was an str path or Image object
+                # GIF input is NOT allowed in this method
+                img = self.__fetch_image(src_img, gif_allowed=False)
+            except FileNotFoundError:
+                # Throw DETAILED exception here (Traceback will be present from previous exceptions)
+                raise FileNotFoundError(f'No image found at given path: {src_img}')
+            except:
+                # Throw DETAILED exception here (Traceback will be present from previous exceptions)
+                raise Exception(
+                    'File format not supported - must be a non-animated image file')
+            self.__set_source(img)
+        if token is not None:
+            self.stats.end('decode', token, 'decode')
+
+    def __set_seed(self, seed: Optional[Union[int, float]]):
+        self.seed = seed
         if self.seed:
-            # Get the same channels on the next call, we have to reset the rng seed
-            # as the previous loop isn't fixed in size of iterations and depends on glitch amount
-            self.__reset_seed()
+            # Set the seed if it was given
+            self.__base_seed = self.seed
+        else:
+            self.__base_seed = random.SystemRandom().getrandbits(64)
 
-        image = Image.fromarray(self.outputarr, self.img_mode)
-        outputarr = self.outputarr
+    def __set_source(self, img: Image.Image):
+        self.__set_pixels(np.asarray(img), img.mode)
 
-        if len(effect_type_seq) > 0:
+    def __set_pixels(self, arr: np.ndarray, mode: str, buffers: bool = True):
+        # Sources are full resolution unless a preview says otherwise
+        self.scale = 1.0
+        # Fetching image attributes
+        self.pixel_tuple_len = len(mode)
+        self.img_height, self.img_width = arr.shape[:2]
+        self.img_mode = mode
+
+        # Assigning the 3D arrays with pixel data
+        self.inputarr = arr
+        self.outputarr = self.inputarr
+        # Frames of the same size keep using the same buffers
+        if buffers and not (self.__buffers and self.__buffers[0].shape == self.inputarr.shape):
+            self.__buffers = (np.empty_like(self.inputarr), np.empty_like(self.inputarr))
+
+    def iter_glitch_animation(self,
+                              src_img: Union[str, Image.Image],
+                              seed: Optional[Union[int, float]] = None,
+                              effect_type_seq=()
+                              ) -> Iterator[Tuple[Image.Image, int]]:
+        """
+         Glitches every frame of an animated image (GIF or APNG) with effect_type_seq
+         Source frames are decoded lazily one at a time, so memory does not grow with
+         the length of the animation
+         Yields (glitched frame, duration in milliseconds) with the timing of the source frame
+        """
+        self.__check_frame_params(seed, 1, 1)
+        if isinstance(src_img, str):
+            if not os.path.isfile(src_img):
+                raise FileNotFoundError(f'No image found at given path: {src_img}')
+            try:
+                # Opening only reads the header, frames are decoded when they are reached
+                src_img = Image.open(src_img)
+            except:
+                raise Exception('File format not supported - must be an image file')
+        elif not isinstance(src_img, Image.Image):
+            raise Exception('File format not supported - must be an image file')
+
+        self.__set_seed(seed)
+        return self.__iter_animation(src_img, effect_type_seq)
+
+    def __iter_animation(self, img: Image.Image, effect_type_seq):
+        # Every frame is converted to the same mode so the buffers can be reused
+        mode = 'RGBA' if 'transparency' in img.info or img.mode in ('RGBA', 'LA', 'PA') else 'RGB'
+        default_duration = img.info.get('duration', 100)
+        for i, frame in enumerate(ImageSequence.Iterator(img)):
+            token = self.stats.begin() if self.stats is not None else None
+            duration = frame.info.get('duration', default_duration)
+            self.__set_source(frame.convert(mode))
+            if token is not None:
+                self.stats.end('decode', token, 'decode', i)
+            yield self.render_frame(i, effect_type_seq), duration
+
+    def glitch_array(self,
+                     arr: np.ndarray,
+                     frame_index: int = 0,
+                     effect_type_seq=(),
+                     seed: Optional[Union[int, float]] = None,
+                     out: Optional[np.ndarray] = None
+                     ) -> np.ndarray:
+        """
+         Glitches decoded pixels without going through PIL, e.g. frames read from a video pipe
+         arr: (height, width, 3 or 4) uint8 array of RGB or RGBA pixels, it is only read
+         frame_index: Index of the frame in the stream, with seed it fixes the random draws
+         Returns one of the glitcher's buffers (or arr itself for an empty effect_type_seq),
+         which is overwritten by the next call, unless out is given to render the frame into
+         out: C-contiguous uint8 array of the shape of arr
+        """
+        if not (isinstance(arr, np.ndarray) and arr.dtype == np.uint8
+                and arr.ndim == 3 and arr.shape[2] in (3, 4)):
+            raise ValueError('arr must be an (height, width, 3 or 4) uint8 array')
+        # The effects write through flat views of out, which only share its data when it is C-contiguous
+        if out is not None and not (isinstance(out, np.ndarray) and out.shape == arr.shape
+                                    and out.dtype == np.uint8 and out.flags.c_contiguous):
+            raise ValueError(f'out must be a C-contiguous uint8 array of shape {arr.shape}')
+        self.__check_frame_params(seed, 1, 1)
+
+        self.__set_seed(seed)
+        self.__set_pixels(arr, 'RGB' if arr.shape[2] == 3 else 'RGBA')
+        self.__frame_index = frame_index
+        self.__apply_effects(effect_type_seq, out)
+        return self.outputarr
+
+    def glitch_tiled(self,
+                     src: Union[str, np.ndarray],
+                     out: Union[str, np.ndarray],
+                     seed: Optional[Union[int, float]] = None,
+                     frame_index: int = 0,
+                     effect_type_seq=(),
+                     band_rows: int = 256
+                     ) -> np.ndarray:
+        """
+         Glitches images too large for memory, e.g. print size scans, band by band
+         src: Path of an .npy file or an (height, width, 3 or 4) uint8 array, usually a
+              np.memmap, of RGB or RGBA pixels. It is only read
+         out: Path of the .npy file to create for the result, or a C-contiguous array of the
+              same shape as src to write it into
+         band_rows: Rows rendered at a time, resident memory grows with band size
+                    instead of image size
+         Every effect runs over all bands before the next one starts, results between
+         effects go to .npy files in gif_dirpath (workspace=True) or a temp directory
+         Geometric effects read exactly the source pixels each band maps to, block effects
+         copy the parts of their blocks that fall into the band
+         The result is the same as glitch_array with the same seed and frame_index
+         Returns the result as a np.memmap (or out itself)
+        """
+        if isinstance(src, str):
+            if not os.path.isfile(src):
+                raise FileNotFoundError(f'No image found at given path: {src}')
+            src = np.load(src, mmap_mode='r')
+        if not (isinstance(src, np.ndarray) and src.dtype == np.uint8
+                and src.ndim == 3 and src.shape[2] in (3, 4)):
+            raise ValueError('src must be an (height, width, 3 or 4) uint8 array or .npy file')
+        self.__check_frame_params(seed, 1, 1)
+        if not (isinstance(band_rows, int) and band_rows > 0):
+            raise ValueError('band_rows param must be a positive integer value greater than 0')
+        if isinstance(out, str):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.uint8, shape=src.shape)
+        elif not (isinstance(out, np.ndarray) and out.shape == src.shape and out.dtype == np.uint8
+                  and out.flags.c_contiguous):
+            # Bands are written through flat views of out, which only share its data when it is C-contiguous
+            raise ValueError(f'out must be a C-contiguous uint8 array of shape {src.shape}')
+
+        self.__set_seed(seed)
+        self.__set_pixels(src, 'RGB' if src.shape[2] == 3 else 'RGBA', buffers=False)
+        self.__frame_index = frame_index
+        self.__reset_seed(frame_index)
+
+        height = self.img_height
+        bands = [(start, min(start + band_rows, height)) for start in range(0, height, band_rows)]
+        stages = len(self.__stages(effect_type_seq))
+
+        with nullcontext(self.gif_dirpath) if self.gif_dirpath else \
+                tempfile.TemporaryDirectory(prefix='glitch_') as workdir:
+            # Two intermediate files at most, stages read from one and write into the other
+            spill = [os.path.join(workdir, f'tiled_{os.getpid()}_{id(self)}_{k}.npy') for k in range(2)]
+
+            def next_target(k):
+                if k == stages - 1:
+                    return out
+                return np.lib.format.open_memmap(spill[k % 2], mode='w+', dtype=np.uint8, shape=src.shape)
+
+            def gather_bands(source, remaps, fused, target):
+                token = self.stats.begin(measure_bytes=True) if self.stats is not None else None
+                for start, stop in bands:
+                    self.__gather(source, remaps, target[start:stop], np.arange(start, stop))
+                if token is not None:
+                    self.stats.end('gather[' + ','.join(EFFECT_NAMES[i] for i in fused) + ']', token,
+                                   'remap', frame_index)
+                return target
+
+            current = target = src
+            remaps = []
+            fused = []
+            k = 0
             for i in effect_type_seq:
-                image = self.effects[i](image)
-                self.outputarr = np.array(image)
+                effect = self.effects[i]
+                if effect in self.remap_effects:
+                    remaps.append(self.remap_effects[effect]())
+                    fused.append(i)
+                    continue
+                if remaps:
+                    current = target = gather_bands(current, remaps, fused, next_target(k))
+                    remaps, fused, k = [], [], k + 1
+                token = self.stats.begin(measure_bytes=True) if self.stats is not None else None
+                apply = self.band_effects[effect]()
+                target = next_target(k)
+                for start, stop in bands:
+                    apply(current, target[start:stop], start, stop)
+                if token is not None:
+                    self.stats.end(EFFECT_NAMES[i], token, 'effect', frame_index)
+                current, k = target, k + 1
+            if remaps:
+                current = target = gather_bands(current, remaps, fused, next_target(k))
+            if current is not out:
+                # No effects, the result is the source
+                for start, stop in bands:
+                    out[start:stop] = src[start:stop]
+            # Drop the maps of the intermediate files before removing them
+            current = target = None
+            for path in spill:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if isinstance(out, np.memmap):
+            out.flush()
+        self.inputarr = self.outputarr = out
+        if self.stats is not None:
+            self.stats.count_frame()
+        return out
+
+    def __stages(self, effect_type_seq):
+        # Effects grouped the way they are run, a run of geometric effects is one fused stage
+        stages = []
+        for i in effect_type_seq:
+            fused = self.effects[i] in self.remap_effects
+            if not (fused and stages and stages[-1][0]):
+                stages.append((fused, []))
+            stages[-1][1].append(i)
+        return stages
+
+    def render_frame(self, frame_index: int, effect_type_seq=()) -> Image.Image:
+        """
+         Renders a single frame of the image set up by glitch_image
+         The result only depends on the seed, the frame index and the effects
+        """
+        self.__frame_index = frame_index
+        return self.__apply_glitch(effect_type_seq)
 
-        self.outputarr = outputarr
+    def __apply_glitch(self, effect_type_seq=()) -> Image.Image:
+        self.__apply_effects(effect_type_seq)
+
+        # Creating glitched image from output array, the only copy of the frame
+        if self.stats is None:
+            return self.__to_image(self.outputarr)
+        token = self.stats.begin(measure_bytes=True)
+        image = self.__to_image(self.outputarr)
+        self.stats.end('to_image', token, 'copy', self.__frame_index)
+        return image
 
+    def __apply_effects(self, effect_type_seq=(), out: Optional[np.ndarray] = None):
+        """
+         Runs the effects on inputarr and leaves the result in outputarr
+         With out, the last effect writes straight into it instead of a buffer
+        """
 
-        # Creating glitched image from output array
-        # return Image.fromarray(self.outputarr, self.img_mode)
+        # Seed both rngs for this frame, the random draws of every effect then only
+        # depend on the frame and not on the frames rendered before it
+        self.__reset_seed(self.__frame_index)
+
+        # Every effect reads the previous result and writes into the other buffer
+        # Geometric effects are collected and applied as a single fused gather
+        # Any other effect is a barrier that needs the pixels remapped so far
+        # With stats, every draw, fused gather and effect is timed on its own
+        stats = self.stats
+        src = self.inputarr
+        bands = self.__thread_bands()
+        remaps = []
+        fused = []
+        for k, i in enumerate(effect_type_seq):
+            effect = self.effects[i]
+            if effect in self.remap_effects:
+                if stats is None:
+                    remaps.append(self.remap_effects[effect]())
+                else:
+                    token = stats.begin()
+                    remaps.append(self.remap_effects[effect]())
+                    stats.end(EFFECT_NAMES[i], token, 'draw', self.__frame_index)
+                fused.append(i)
+                continue
+            if remaps:
+                src = self.__flush_remaps(src, remaps, fused, self.__next_buffer(src), bands)
+                remaps, fused = [], []
+            dst = out if out is not None and k == len(effect_type_seq) - 1 else self.__next_buffer(src)
+            if stats is None:
+                self.__run_effect(effect, src, dst, bands)
+            else:
+                token = stats.begin(measure_bytes=True)
+                self.__run_effect(effect, src, dst, bands)
+                stats.end(EFFECT_NAMES[i], token, 'effect', self.__frame_index)
+            src = dst
+        if remaps:
+            src = self.__flush_remaps(src, remaps, fused, self.__next_buffer(src) if out is None else out, bands)
+        elif out is not None and src is not out:
+            out[...] = src
+            src = out
+        self.outputarr = src
+        if stats is not None:
+            stats.count_frame()
+
+    def __flush_remaps(self, src: np.ndarray, remaps, fused, dst: np.ndarray, bands=None) -> np.ndarray:
+        # Gathers the pending remaps, fused holds the indices of their effects
+        token = self.stats.begin(measure_bytes=True) if self.stats is not None else None
+        if bands is None:
+            self.__gather(src, remaps, dst)
+        else:
+            # The remaps were drawn when they were built, every band only evaluates them
+            self.__run_bands(bands, lambda start, stop: self.__gather(src, remaps, dst[start:stop],
+                                                                      np.arange(start, stop)))
+        if token is not None:
+            self.stats.end('gather[' + ','.join(EFFECT_NAMES[i] for i in fused) + ']', token, 'remap',
+                           self.__frame_index)
+        return dst
+
+    def __run_effect(self, effect, src: np.ndarray, dst: np.ndarray, bands=None):
+        if bands is None:
+            effect(src, dst)
+            return
+        # The builder draws the random values of the whole frame, then the bands are rendered
+        if effect == self.__analog_noise:
+            # Exact noise is drawn for the whole frame too, so the bands can add it in any order
+            apply = self.__analog_noise_bands(any_order=True)
+        else:
+            apply = self.band_effects[effect]()
+        self.__run_bands(bands, lambda start, stop: apply(src, dst[start:stop], start, stop))
+
+    def __thread_bands(self):
+        # Row bands of a frame rendered with threads, None to render it in one piece
+        if self.threads == 1:
+            return None
+        # A few bands per thread even out bands that take longer than others
+        count = min(4 * self.threads, self.img_height // MIN_BAND_ROWS)
+        if count < 2:
+            return None
+        edges = [self.img_height * k // count for k in range(count + 1)]
+        return list(zip(edges[:-1], edges[1:]))
+
+    def __run_bands(self, bands, render):
+        # Calls render(row_start, row_stop) for every band on the thread pool and waits for all
+        if self.__thread_pool is None or self.__thread_pool_pid != os.getpid():
+            self.__thread_pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='glitch_band')
+            self.__thread_pool_pid = os.getpid()
+        for future in [self.__thread_pool.submit(render, start, stop) for start, stop in bands]:
+            future.result()
+
+    def __next_buffer(self, src: np.ndarray) -> np.ndarray:
+        # The buffer that src is not
+        if src is self.__buffers[0]:
+            return self.__buffers[1]
+        return self.__buffers[0]
+
+    def __to_image(self, arr: np.ndarray) -> Image.Image:
+        # The buffers are reused for the next frame, so the Image must not share their memory
+        image = Image.fromarray(arr, self.img_mode)
+        if image.readonly:
+            image = image.copy()
         return image
 
     def __reset_seed(self, offset: int = 0):
         """
-        Calls random.seed() with self.seed variable
-        offset is for looping and getting new positions for each iteration that contains the
-        previous one, otherwise we would get the same position on every loop and different
-        results afterwards on non fixed size loops
+        Seeds the random and np.random streams of the glitcher with a seed derived from the
+        base seed and sets up a numpy Generator from the same seed
+        offset is the frame index, every frame gets its own positions that do not depend
+        on how many draws the previous frames made
         """
-        random.seed(self.seed + offset)
+        seed = frame_seed(self.__base_seed, offset)
+        self.__random.seed(seed)
+        self.__np_random.seed(seed)
+        self.__rng = np.random.default_rng(seed)
 
     def clamp_int(self, x, max_, min_=0):
         if x < min_:
@@ -292,268 +898,479 @@ class ImageGlitcher:
         else:
             return int(x)
 
-    def __analog_noise(self, image: Image.Image, mean=0, stddev=50) -> Image.Image:
-        noise = np.random.randn(*self.outputarr.shape) * stddev
-        np.clip(noise, 0, 255, out=noise).astype('uint16')
+    def __scaled(self, pixels):
+        # A length in pixels of the full resolution image, at the resolution being glitched
+        if self.scale == 1:
+            return pixels
+        return max(1, round(pixels * self.scale))
+
+    def __analog_noise(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__analog_noise_bands(**params)(src, dst, 0, self.img_height)
 
-        np.add(self.outputarr.astype('uint16'), noise, out=noise)
-        return Image.fromarray(np.clip(noise, 0, 255).astype('uint8'), self.img_mode)
+    def __analog_noise_bands(self, mean=0, stddev=50, any_order=False):
+        # float32 noise turned into uint8 and added with saturation, no float frame temporaries
+        add = self.__noise.plan(self.__rng, (self.img_height, self.img_width, self.pixel_tuple_len),
+                                mean, stddev, pool_seed=frame_seed(self.__base_seed, NOISE_POOL_INDEX),
+                                any_order=any_order)
 
-    def __rgb_split(self, image: Image.Image, mean=0, stddev=0.01) -> Image.Image:
+        def apply(src, dst, row_start, row_stop):
+            add(src[row_start:row_stop], dst, row_start)
+
+        return apply
+
+    def __compile_remaps(self, remaps, height, width, channels, rows=None):
+        """
+         Composes a chain of remaps into flat source indices
+         A remap is a (function, channels) pair, function(rows, cols, channel) returns the
+         source coordinates of the given output coordinates and channels lists the channels
+         it treats differently from the rest
+         The functions are evaluated from the last remap back to the first, so the result
+         points straight into the image before the first remap
+         Channels share one map until a remap treats them differently
+         rows: Output rows to compile, defaults to all of them
+         Returns a list of (channels, flat index), one for every distinct map
+        """
+        if rows is None:
+            rows = np.arange(height)
+        band_height = len(rows)
+        rows = rows[:, np.newaxis]
+        cols = np.arange(width)[np.newaxis, :]
+        entries = [(list(range(channels)), rows, cols)]
+        for remap, remap_channels in reversed(remaps):
+            if remap_channels:
+                split_entries = []
+                for group, rows, cols in entries:
+                    rest = [c for c in group if c not in remap_channels]
+                    split_entries += [([c], rows, cols) for c in group if c in remap_channels]
+                    if rest:
+                        split_entries.append((rest, rows, cols))
+                entries = split_entries
+            entries = [(group,) + remap(rows, cols, group[0]) for group, rows, cols in entries]
+
+        return [(group, np.broadcast_to(rows * width + cols, (band_height, width)).ravel())
+                for group, rows, cols in entries]
+
+    def __gather(self, src: np.ndarray, remaps, dst: np.ndarray, rows=None) -> np.ndarray:
+        """
+         Applies a chain of remaps to src with a single gather per channel into dst
+         With rows, only those output rows are gathered into dst, which has one row for each
+        """
+        height, width = src.shape[:2]
+        channels = src.shape[2] if src.ndim == 3 else 1
+
+        flat_src = src.reshape(height * width, channels)
+        flat_frame = dst.reshape(-1, channels)
+
+        index_maps = self.__compile_remaps(remaps, height, width, channels, rows)
+        if len(index_maps) == 1:
+            # Every channel is moved the same way, gather whole pixels
+            _, index = index_maps[0]
+            np.take(flat_src, index, axis=0, out=flat_frame)
+        else:
+            # Otherwise one gather per channel
+            for group, index in index_maps:
+                for c in group:
+                    flat_frame[:, c] = np.take(flat_src[:, c], index)
+        return dst
+
+    def __row_shift_remap(self, shifts, row_offset=0):
+        """
+         Shared row shift kernel
+         Every row y of the result is row (y + row_offset) of the source rolled left by shifts[y]
+         with wrap-around, i.e. result[y, x] = src[(y + row_offset) % height, (x + shifts[y]) % width]
+         shifts may also be a single number for the whole image
+        """
+        height = self.img_height
+        width = self.img_width
+        shifts = np.asarray(shifts, dtype=np.intp) % width
+        row_offset %= height
+
+        def remap(rows, cols, channel):
+            if row_offset:
+                rows = (rows + row_offset) % height
+            cols = cols + (shifts[rows] if shifts.ndim else shifts)
+            # Cheaper than a modulo, the sum is always below 2 * width
+            np.subtract(cols, width, out=cols, where=cols >= width)
+            return rows, cols
+
+        return remap, ()
+
+    def __rgb_split(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__gather(src, [self.__rgb_split_remap(**params)], dst)
+
+    def __rgb_split_remap(self, mean=0, stddev=0.01):
         width = self.img_width
         height = self.img_height
 
-        x_offset = random.normalvariate(mean, stddev) * width
-        y_offset = random.normalvariate(mean, stddev) * height
+        x_offset = self.__random.normalvariate(mean, stddev) * width
+        y_offset = self.__random.normalvariate(mean, stddev) * height
 
-        frame = self.outputarr.copy()
+        # Red is read from +offset and blue from -offset, clipped with the same rounding as clamp_int
+        def remap(rows, cols, channel):
+            if channel == 0:
+                return (np.clip(rows + y_offset, 0, height - 1).astype(np.intp),
+                        np.clip(cols + x_offset, 0, width - 1).astype(np.intp))
+            if channel == 2:
+                return (np.clip(rows - y_offset, 0, height - 1).astype(np.intp),
+                        np.clip(cols - x_offset, 0, width - 1).astype(np.intp))
+            return rows, cols
 
-        for y in range(self.img_height):
-            for x in range(self.img_width):
-                frame[y][x][0] = self.outputarr[self.clamp_int(y + y_offset, height - 1)][self.clamp_int(x + x_offset, width - 1)][0]
-                frame[y][x][2] = self.outputarr[self.clamp_int(y - y_offset, height - 1)][self.clamp_int(x - x_offset, width - 1)][2]
+        return remap, (0, 2)
 
-        return Image.fromarray(frame, self.img_mode)
+    def __tile_jitter(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__gather(src, [self.__tile_jitter_remap(**params)], dst)
 
-    def __tile_jitter(self, image: Image.Image, strip_height=50, mean=0, stddev=0.1) -> Image.Image:
-        x_offset = random.normalvariate(mean, stddev) * image.width
-        original = image.copy()
+    def __tile_jitter_remap(self, strip_height=50, mean=0, stddev=0.1):
+        strip_height = self.__scaled(strip_height)
+        x_offset = self.__random.normalvariate(mean, stddev) * self.img_width
 
-        width = image.width
-        height = image.height
-        prev_strip = -1
+        height = self.img_height
+        strip_num = (height + strip_height - 1) // strip_height
 
-        for y in range(height):
-            current_strip = y // strip_height
-            is_jittered = current_strip % 2 == 0
-            if prev_strip != current_strip:
-                x_offset = int(random.normalvariate(mean, stddev) * image.width)
-            prev_strip = current_strip
-            for x in range(width):
-                if is_jittered:
-                    image.putpixel((x, y), original.getpixel(((x + x_offset) % width, y)))
-        return image
+        # Every strip draws an offset to keep the rng sequence, only the even ones are jittered
+        strip_offsets = np.array([int(self.__random.normalvariate(mean, stddev) * self.img_width) for _ in range(strip_num)],
+                                 dtype=np.intp)
+        strip_offsets[1::2] = 0
+        shifts = np.repeat(strip_offsets, strip_height)[:height]
 
-    def __screen_jump(self, image: Image.Image, vertical=True):
-        if not vertical:
-            start_y = 0
-            stop_y = self.img_height
-
-            # For copy
-            start_x = int(0.15 * self.img_width)
-            # For paste
-            stop_x = self.img_width - start_x
-
-            left_chunk = self.outputarr[start_y:stop_y, start_x:]
-            wrap_chunk = self.outputarr[start_y:stop_y, :start_x]
-            self.outputarr[start_y:stop_y, :stop_x] = left_chunk
-            self.outputarr[start_y:stop_y, stop_x:] = wrap_chunk
-        else:
-            start_x = 0
-            stop_x = self.img_width
+        return self.__row_shift_remap(shifts)
 
-            # For copy
-            start_y = int(0.15 * self.img_height)
-            # For paste
-            stop_y = self.img_height - start_y
+    def __screen_jump(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__gather(src, [self.__screen_jump_remap(**params)], dst)
 
-            up_chunk = self.outputarr[start_y:, start_x:stop_x]
-            wrap_chunk = self.outputarr[:start_y, start_x:stop_x]
-            self.outputarr[:stop_y, start_x:stop_x] = up_chunk
-            self.outputarr[stop_y:, start_x:stop_x] = wrap_chunk
+    def __screen_jump_remap(self, vertical=True):
+        # The screen keeps jumping by the same amount on every frame
+        jump_step = self.__frame_index + 1
 
-        return Image.fromarray(self.outputarr, self.img_mode)
+        if not vertical:
+            jump = int(0.15 * self.img_width) * jump_step
+            return self.__row_shift_remap(jump)
+        else:
+            jump = int(0.15 * self.img_height) * jump_step
+            return self.__row_shift_remap(0, row_offset=jump)
 
-    def __screen_shake(self, image: Image.Image, amplitude=5):
-        start_y = 0
-        stop_y = self.img_height
+    def __screen_shake(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__gather(src, [self.__screen_shake_remap(**params)], dst)
 
+    def __screen_shake_remap(self, amplitude=5):
         # For copy
-        offset = random.random()
+        offset = self.__random.random()
         if offset < 0.5:
             offset = offset / amplitude
         else:
             offset = 1 - offset / amplitude
 
         start_x = int(offset * self.img_width)
-        # For paste
-        stop_x = self.img_width - start_x
-        shake_array = self.outputarr.copy()
-
-        left_chunk = self.outputarr[start_y:stop_y, start_x:]
-        wrap_chunk = self.outputarr[start_y:stop_y, :start_x]
-        shake_array[start_y:stop_y, :stop_x] = left_chunk
-        shake_array[start_y:stop_y, stop_x:] = wrap_chunk
+        return self.__row_shift_remap(start_x)
 
-        return Image.fromarray(shake_array, self.img_mode)
+    def __wave_jitter(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__gather(src, [self.__wave_jitter_remap(**params)], dst)
 
-    def __wave_jitter(self, image: Image.Image, wave=10, amplitude=10):
+    def __wave_jitter_remap(self, wave=10, amplitude=10):
+        amplitude = self.__scaled(amplitude)
         height = self.img_height
         vertical_range = height / wave
-        offset = random.randint(0, self.img_height)
-        shake_array = self.outputarr.copy()
-        for i in range(height):
-            omega = ((i + offset) % vertical_range) / vertical_range * 2 * math.pi
-            shift = int(amplitude * math.sin(omega))
-
-            start_y = i
-            stop_y = i + 1
-
-            if shift > 0:
-                start_x = shift
-                stop_x = self.img_width - shift
-            elif shift < 0:
-                shift *= -1
-                start_x = self.img_width - shift
-                stop_x = shift
-            else:
-                continue
+        offset = self.__random.randint(0, self.img_height)
 
-            left_chunk = self.outputarr[start_y:stop_y, start_x:]
-            wrap_chunk = self.outputarr[start_y:stop_y, :start_x]
-            shake_array[start_y:stop_y, :stop_x] = left_chunk
-            shake_array[start_y:stop_y, stop_x:] = wrap_chunk
-        return Image.fromarray(shake_array, self.img_mode)
+        # Shift of every row along one period of the sine wave
+        omega = ((np.arange(height) + offset) % vertical_range) / vertical_range * 2 * math.pi
+        shifts = (amplitude * np.sin(omega)).astype(np.intp)
 
-    def __image_block(self, image: Image.Image, color_effect=False,
-                      num_mean=10, num_stddev=10,
-                      size_mean=0.09, size_stddev=0.03,
-                      offset_mean=0, offset_stddev=0.05) -> Image.Image:
-        original = image.copy()
-        block_num = int(random.normalvariate(num_mean, num_stddev))
-        height = image.height
-        width = image.width
+        return self.__row_shift_remap(shifts)
 
-        colors = ["#b4b2b5", "#dfd73f", "#6ed2dc", "#66cf5d", "#c542cb", "#d0535e", "#3733c9"]
+    @staticmethod
+    def __block_runs(start, length, offset, size):
+        """
+         Splits the block range [start, start + length) along one axis into runs of
+         (dst_start, dst_stop, src_start) that can be copied as plain slices
+         The source is read at +offset and wraps around, the destination is clamped
+         to the image so everything past the edge lands on the last line (last write wins)
+        """
+        stop = min(start + length, size)
+        runs = []
+        pos = start
+        while pos < stop:
+            src_start = (pos + offset) % size
+            run_len = min(stop - pos, size - src_start)
+            runs.append((pos, pos + run_len, src_start))
+            pos += run_len
+        if start + length > size:
+            runs.append((size - 1, size, (start + length - 1 + offset) % size))
+        return runs
+
+    def __copy_block(self, dst: np.ndarray, src: np.ndarray,
+                     x, y, len_x, len_y, offset_x, offset_y, transform=None,
+                     row_start=0, row_stop=None):
+        """
+         Copies one displaced block from src to dst with at most four wrapped sub-slices
+         (plus the clamped edge lines), transform is applied to every copied piece
+         Only rows [row_start, row_stop) of the result are written, dst holds just those rows
+        """
+        height, width = src.shape[:2]
+        if row_stop is None:
+            row_stop = height
+        for dst_y0, dst_y1, src_y in self.__block_runs(y, len_y, offset_y, height):
+            # Cut the run down to the band, the source rows move along with it
+            top, bottom = max(dst_y0, row_start), min(dst_y1, row_stop)
+            if top >= bottom:
+                continue
+            src_y += top - dst_y0
+            for dst_x0, dst_x1, src_x in self.__block_runs(x, len_x, offset_x, width):
+                piece = src[src_y:src_y + bottom - top, src_x:src_x + dst_x1 - dst_x0]
+                if transform is not None:
+                    piece = transform(piece)
+                dst[top - row_start:bottom - row_start, dst_x0:dst_x1, :piece.shape[2]] = piece
+
+    def __image_block(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__image_block_bands(**params)(src, dst, 0, self.img_height)
+
+    def __image_block_bands(self, color_effect=False,
+                            num_mean=10, num_stddev=10,
+                            size_mean=0.09, size_stddev=0.03,
+                            offset_mean=0, offset_stddev=0.05):
+        block_num = int(self.__random.normalvariate(num_mean, num_stddev))
+        height = self.img_height
+        width = self.img_width
 
+        blocks = []
         for _ in range(block_num):
-            x = random.randint(0, width - 1)
-            y = random.randint(0, height - 1)
+            x = self.__random.randint(0, width - 1)
+            y = self.__random.randint(0, height - 1)
 
-            len_x = int(random.normalvariate(size_mean, size_stddev) * width * 3)
-            len_y = int(random.normalvariate(size_mean, size_stddev) * height)
+            len_x = int(self.__random.normalvariate(size_mean, size_stddev) * width * 3)
+            len_y = int(self.__random.normalvariate(size_mean, size_stddev) * height)
 
-            offset_x = int(random.normalvariate(offset_mean, offset_stddev) * width)
-            offset_y = int(random.normalvariate(offset_mean, offset_stddev) * height)
+            offset_x = int(self.__random.normalvariate(offset_mean, offset_stddev) * width)
+            offset_y = int(self.__random.normalvariate(offset_mean, offset_stddev) * height)
 
-            color = np.random.randint(3, size=4)
+            color = self.__np_random.randint(3, size=4)[:self.pixel_tuple_len]
 
             if color_effect:
-                for j in range(y, y + len_y):
-                    for i in range(x, x + len_x):
-                        image.putpixel((self.clamp_int(i, width - 1, 0), self.clamp_int(j, height - 1, 0)),
-                                       tuple(min(m * n, 255) for (m, n) in zip(color,
-                                                                               original.getpixel(
-                                                                                   ((i + offset_x) % width,
-                                                                                    (j + offset_y) % height)))))
+                # Saturating multiply of every channel, broadcast over the whole piece
+                def transform(piece, color=color):
+                    return np.minimum(piece * color, 255).astype(np.uint8)
             else:
-                for j in range(y, y + len_y):
-                    for i in range(x, x + len_x):
-                        image.putpixel((self.clamp_int(i, width - 1, 0), self.clamp_int(j, height - 1, 0)),
-                                       original.getpixel(((i + offset_x) % width, (j + offset_y) % height)))
-        return image
+                transform = None
+            blocks.append((x, y, len_x, len_y, offset_x, offset_y, transform))
+
+        def apply(src, dst, row_start, row_stop):
+            dst[...] = src[row_start:row_stop]
+            for block in blocks:
+                self.__copy_block(dst, src, *block, row_start=row_start, row_stop=row_stop)
+
+        return apply
 
-    def __image_block_hsv(self, image: Image.Image,
-                      num_mean=8, num_stddev=3,
-                      size_mean=0.09, size_stddev=0.03,
-                      offset_mean=0, offset_stddev=0.05) -> Image.Image:
-        arr = np.array(image.convert(mode="HSV"))
-        ori = image.copy()
-        block_num = int(random.normalvariate(num_mean, num_stddev))
+    def __image_block_hsv(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__image_block_hsv_bands(**params)(src, dst, 0, self.img_height)
 
+    def __image_block_hsv_bands(self, num_mean=8, num_stddev=3,
+                                size_mean=0.09, size_stddev=0.03,
+                                offset_mean=0, offset_stddev=0.05):
+        block_num = int(self.__random.normalvariate(num_mean, num_stddev))
+        mode = self.img_mode
+
+        blocks = []
         for _ in range(block_num):
-            x = random.randint(0, self.img_width - 1)
-            y = random.randint(0, self.img_height - 1)
+            x = self.__random.randint(0, self.img_width - 1)
+            y = self.__random.randint(0, self.img_height - 1)
 
-            len_x = int(random.normalvariate(size_mean, size_stddev) * self.img_width * 5)
-            len_y = int(random.normalvariate(size_mean, size_stddev) * self.img_height)
+            len_x = int(self.__random.normalvariate(size_mean, size_stddev) * self.img_width * 5)
+            len_y = int(self.__random.normalvariate(size_mean, size_stddev) * self.img_height)
 
-            offset_x = int(random.normalvariate(offset_mean, offset_stddev) * self.img_width)
-            offset_y = int(random.normalvariate(offset_mean, offset_stddev) * self.img_height)
+            offset_x = int(self.__random.normalvariate(offset_mean, offset_stddev) * self.img_width)
+            offset_y = int(self.__random.normalvariate(offset_mean, offset_stddev) * self.img_height)
 
-            color = (np.random.randn(4) + 1).astype('uint16')
+            # Hue, saturation and value multipliers, the fourth draw is kept for the rng sequence
+            color = np.maximum(self.__np_random.randn(4) + 1, 0).astype('uint16')[:3]
 
-            for j in range(y, y + len_y):
-                for i in range(x, x + len_x):
-                    image.putpixel((self.clamp_int(i, self.img_width - 1, 0), self.clamp_int(j, self.img_height - 1, 0)),
-                                   tuple(min(m * n, 255) for (m, n) in zip(color,
-                                                                           ori.getpixel(
-                                                                               ((i + offset_x) % self.img_width,
-                                                                                (j + offset_y) % self.img_height)))))
-        return image
+            # Pieces are converted to HSV as they are copied, HSV is per pixel so this
+            # is the same as reading them from the HSV version of the whole image
+            def transform(piece, color=color):
+                hsv = np.asarray(Image.fromarray(np.ascontiguousarray(piece), mode)
+                                 .convert(mode='RGB').convert(mode='HSV'))
+                shifted = hsv * color
+                # Hue is circular, saturation and value saturate
+                shifted[:, :, 0] %= 256
+                shifted = np.minimum(shifted, 255).astype(np.uint8)
+                return np.asarray(Image.fromarray(shifted, 'HSV').convert('RGB'))
+
+            blocks.append((x, y, len_x, len_y, offset_x, offset_y, transform))
+
+        def apply(src, dst, row_start, row_stop):
+            dst[...] = src[row_start:row_stop]
+            for block in blocks:
+                self.__copy_block(dst, src, *block, row_start=row_start, row_stop=row_stop)
+
+        return apply
 
-    def __scan_line(self, image: Image.Image, offset_ratio=0.1, total_step=30):
-        self.__scan_line_current_step = (self.__scan_line_current_step + 1) % total_step
+    def __scan_line(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__gather(src, [self.__scan_line_remap(**params)], dst)
 
-        amplitude = math.sin(self.__scan_line_current_step / total_step * 2 * math.pi)
+    def __scan_line_remap(self, offset_ratio=0.1, total_step=30):
+        # The phase of the scan line moves with the frame index
+        current_step = (self.__frame_index + 1) % total_step
+
+        amplitude = math.sin(current_step / total_step * 2 * math.pi)
 
         width = self.img_width
         height = self.img_height
-        shake_array = self.outputarr.copy()
-        for i in range(height):
-            shift = int(
-                amplitude * self.clamp_int(int(random.normalvariate(0, int(width * offset_ratio))), width, -width))
-            start_y = i
-            stop_y = i + 1
-
-            if shift > 0:
-                start_x = shift
-                stop_x = self.img_width - shift
-            elif shift < 0:
-                shift *= -1
-                start_x = self.img_width - shift
-                stop_x = shift
-            else:
-                continue
 
-            left_chunk = self.outputarr[start_y:stop_y, start_x:]
-            wrap_chunk = self.outputarr[start_y:stop_y, :start_x]
-            shake_array[start_y:stop_y, :stop_x] = left_chunk
-            shake_array[start_y:stop_y, stop_x:] = wrap_chunk
-        return Image.fromarray(shake_array, self.img_mode)
+        # One draw per row, in row order like before
+        deviation = int(width * offset_ratio)
+        draws = np.array([self.__random.normalvariate(0, deviation) for _ in range(height)])
+        shifts = (amplitude * np.clip(np.trunc(draws), -width, width)).astype(np.intp)
 
-    def __line_block(self, image: Image.Image, glitch_in=0.1, glitch_out=0.2, mean=0, stddev=0.1):
-        width = image.width
-        height = image.height
-        original = image.copy()
+        return self.__row_shift_remap(shifts)
 
+    def __line_block(self, src: np.ndarray, dst: np.ndarray, **params):
+        self.__gather(src, [self.__line_block_remap(**params)], dst)
+
+    def __line_block_remap(self, glitch_in=0.1, glitch_out=0.2, mean=0, stddev=0.1):
+        width = self.img_width
+        height = self.img_height
+        if self.scale != 1:
+            # Chances per row, glitched runs cover as many full resolution rows at any scale
+            glitch_in = 1 - (1 - glitch_in) ** (1 / self.scale)
+            glitch_out = 1 - (1 - glitch_out) ** (1 / self.scale)
+
+        # Work out the glitch state of every row first, the draws depend on the previous row
+        glitched = np.zeros(height, dtype=bool)
+        offsets = np.zeros(height, dtype=np.intp)
         glitch = False
-        offset = int(random.normalvariate(mean, stddev) * image.width)
+        offset = int(self.__random.normalvariate(mean, stddev) * width)
         for y in range(height):
-            if not glitch and random.random() < glitch_in:
-                offset = int(random.normalvariate(mean, stddev) * image.width)
+            if not glitch and self.__random.random() < glitch_in:
+                offset = int(self.__random.normalvariate(mean, stddev) * width)
                 glitch = not glitch
-            elif glitch and random.random() < glitch_out:
+            elif glitch and self.__random.random() < glitch_out:
                 glitch = not glitch
+            glitched[y] = glitch
+            offsets[y] = offset
 
-            for x in range(width):
-                if glitch:
-                    image.putpixel((x, y), original.getpixel((self.clamp_int(x + offset, width - 1), y)))
-        return image
+        # Glitched rows are read from a clipped offset, the others stay in place
+        def remap(rows, cols, channel):
+            shifted = np.clip(cols + offsets[rows], 0, width - 1)
+            return rows, np.where(glitched[rows], shifted, cols)
+
+        return remap, ()
 
-    def __color_block(self, image):
+    def __color_block(self, src: np.ndarray, dst: np.ndarray):
+        self.__color_block_bands()(src, dst, 0, self.img_height)
+
+    def __color_block_bands(self):
         colors = [(185, 65, 210, 128), (96, 178, 78, 128), (236, 68, 68, 128), (37, 128, 190, 128), (220, 43, 255, 128), (128, 128, 255, 128), (128, 212, 64, 128)]
         canvas_height = self.img_height
         canvas_width = self.img_width
-        bnw_layer = Image.new('RGBA', (canvas_width, canvas_height), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(bnw_layer)
-        for i in range(1000):
-            x0 = int(random.random() * canvas_width)
-            y0 = int(random.random() * canvas_height)
-            dx = int(random.random() * 25)
-            dy = int(random.random() * 25)
-            alpha_w = int(255 * 0.5 * random.random())
-            alpha_b = int(255 * 0.5 * random.random())
-            draw.rectangle([x0, y0, x0 + dx, y0 + dy], fill=(0, 0, 0, alpha_b))
-            draw.rectangle([x0, y0, x0 + dx, y0 + dy], fill=(255, 255, 255, alpha_w))
-
-        color_index = random.randint(0, 6)
-        y = int(random.random() * canvas_height)
-        x = int(random.random() * canvas_width)
-        draw.rectangle([x, y, min(x + x, canvas_width), min(y + y, canvas_height)], fill=colors[color_index])
-
-        res = Image.alpha_composite(image.convert('RGBA'), bnw_layer)
-        background = Image.new("RGB", res.size, (255, 255, 255))
-        background.paste(res, mask=res.split()[3])  # 3 is the alpha channel
-
-        return res
+        squares = 1000
+        # Squares are up to 25 full resolution pixels wide
+        square_size = self.__scaled(25)
+
+        # Same draws in the same order as one square at a time: x0, y0, dx, dy, alpha_w, alpha_b
+        draws = np.array([self.__random.random() for _ in range(6 * squares)]).reshape(squares, 6)
+        x0 = (draws[:, 0] * canvas_width).astype(np.intp)
+        y0 = (draws[:, 1] * canvas_height).astype(np.intp)
+        dx = (draws[:, 2] * square_size).astype(np.intp)
+        dy = (draws[:, 3] * square_size).astype(np.intp)
+        # Every black square is drawn over by its white square right away, only the white alpha shows
+        alpha_w = (255 * 0.5 * draws[:, 4]).astype(np.uint8)
+
+        color_index = self.__random.randint(0, 6)
+        y = int(self.__random.random() * canvas_height)
+        x = int(self.__random.random() * canvas_width)
+        rect_cols = slice(x, min(x + x, canvas_width) + 1)
+        rect_stop = min(y + y, canvas_height) + 1
+
+        def apply(src, dst, row_start, row_stop):
+            # Rasterize all squares reaching into the band at once, every pixel keeps the last
+            # square drawn over it
+            # Squares span dx + 1 by dy + 1 pixels (inclusive corners) and are cut at the border
+            band = np.flatnonzero((y0 < row_stop) & (y0 + dy >= row_start))
+            offsets = np.arange(square_size)
+            cols = x0[band, None, None] + offsets[None, None, :]
+            rows = y0[band, None, None] + offsets[None, :, None]
+            inside = ((offsets[None, None, :] <= dx[band, None, None]) & (cols < canvas_width)
+                      & (offsets[None, :, None] <= dy[band, None, None])
+                      & (rows >= row_start) & (rows < row_stop))
+            order = np.broadcast_to(band.astype(np.int16)[:, None, None], inside.shape)
+            layer = np.full((row_stop - row_start) * canvas_width, -1, dtype=np.int16)
+            np.maximum.at(layer, ((rows - row_start) * canvas_width + cols)[inside], order[inside])
+
+            # White squares over the source, then the color rectangle over them,
+            # every composite reads the source pixels as the layer overwrites and does not blend
+            src = src[row_start:row_stop]
+            dst[...] = src
+            covered = np.flatnonzero(layer >= 0)
+            flat_src = src.reshape(-1, src.shape[-1])
+            flat_dst = dst.reshape(-1, dst.shape[-1])
+            flat_dst[covered] = self.__alpha_composite(flat_src[covered], (255, 255, 255),
+                                                       alpha_w[layer[covered]])
+
+            top, bottom = max(y, row_start) - row_start, min(rect_stop, row_stop) - row_start
+            if top < bottom:
+                dst[top:bottom, rect_cols] = self.__alpha_composite(
+                    src[top:bottom, rect_cols], colors[color_index][:3], colors[color_index][3])
+
+        return apply
+
+    def __alpha_composite(self, pixels: np.ndarray, fill, fill_alpha: Union[int, np.ndarray]) -> np.ndarray:
+        """
+         Composites one fill color with a single or per pixel alpha over RGB or RGBA pixels
+         Same integer arithmetic as Pillow's Image.alpha_composite, so the result is identical
+         RGB pixels are opaque, their result only depends on (fill, alpha, value) and is
+         looked up in a table instead
+        """
+        if pixels.shape[-1] != 3:
+            return self.__composite_rgba(pixels, fill, fill_alpha)
+        out = np.empty_like(pixels)
+        for c in range(3):
+            table = self.__composite_table(fill[c])
+            if isinstance(fill_alpha, int):
+                out[..., c] = table[fill_alpha][pixels[..., c]]
+            else:
+                out[..., c] = table[fill_alpha, pixels[..., c]]
+        return out
+
+    @staticmethod
+    def __composite_rgba(pixels: np.ndarray, fill, fill_alpha: Union[int, np.ndarray]) -> np.ndarray:
+        # Pillow's AlphaComposite.c with 7 bits of extra precision, in uint32
+        precision_bits = 7
+        pixels = pixels.astype(np.uint32)
+        fill = np.asarray(fill, dtype=np.uint32)
+        fill_alpha = np.asarray(fill_alpha, dtype=np.uint32)[..., None]
+        dst_alpha = pixels[..., 3:]
+
+        def div255(a):
+            return ((a >> 8) + a) >> 8
+
+        out_alpha255 = fill_alpha * 255 + dst_alpha * (255 - fill_alpha)
+        coef1 = fill_alpha * (255 * 255 << precision_bits) // np.maximum(out_alpha255, 1)
+        coef2 = (255 << precision_bits) - coef1
+        out = np.empty_like(pixels)
+        out[..., :3] = div255(fill * coef1 + pixels[..., :3] * coef2 + (0x80 << precision_bits)) >> precision_bits
+        out[..., 3:] = div255(out_alpha255 + 0x80)
+        # Fully transparent fill leaves the pixel untouched
+        return np.where(fill_alpha == 0, pixels, out).astype(np.uint8)
+
+    def __composite_table(self, fill_value: int) -> np.ndarray:
+        # (alpha, value) -> composite of fill_value over an opaque value, cached per fill value
+        if fill_value not in self.__composite_tables:
+            alpha, value = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+            opaque = np.stack([value] * 3 + [np.full_like(value, 255)], axis=-1)
+            self.__composite_tables[fill_value] = self.__composite_rgba(
+                opaque, (fill_value,) * 3, alpha)[..., 0]
+        return self.__composite_tables[fill_value]
+
+
+# Glitcher of a frame rendering process, set up once per process by the pool initializer
+_frame_worker = None
+
+
+def _init_frame_worker(pixels, mode, seed, base_seed, noise_tiles, scale, effect_type_seq):
+    global _frame_worker
+    _frame_worker = (ImageGlitcher._for_frame_worker(pixels, mode, seed, base_seed, noise_tiles, scale),
+                     effect_type_seq)
+
+
+def _render_frame_worker(frame_index: int) -> Image.Image:
+    glitcher, effect_type_seq = _frame_worker
+    return glitcher.render_frame(frame_index, effect_type_seq)
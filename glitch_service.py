@@ -0,0 +1,317 @@
+# Local render service
+# A long running asyncio HTTP server, on TCP or a Unix socket, in front of a pool of warm
+# glitcher processes. Jobs no longer pay for interpreter start up, imports and glitcher set up
+#   POST /render?effects=10,1&seed=5&frames=23&step=1  body: the image file
+#        returns the glitched GIF, or a PNG for frames=1
+#        with &preview=512 it is rendered at a proxy resolution of at most 512 x 512
+#   GET  /stats  returns the counters of the service as JSON
+# Identical requests that are in flight at the same time are rendered once, and recent
+# results are kept in an in-memory LRU. Only seeded requests are shared, unseeded ones
+# are meant to come out different every time. A seed of 0 is no seed, like for the glitcher
+# Load test it with service_load.py
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image
+
+from frame_writer import GifWriter
+from glitch_effect import EFFECT_NAMES, ImageGlitcher
+
+DEFAULT_PORT = 8580
+DEFAULT_CACHE_MB = 256
+# Largest accepted request body
+MAX_BODY_BYTES = 64 * 2 ** 20
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 422: 'Unprocessable Entity', 500: 'Internal Server Error'}
+
+# Glitcher of a worker process, created once when the process starts
+_service_glitcher = None
+
+
+def _init_service_worker():
+    global _service_glitcher
+    _service_glitcher = ImageGlitcher()
+
+
+def _warm_up() -> int:
+    # Runs every effect once, so the first real request finds everything imported and set up
+    _service_glitcher.glitch_image(np.zeros((16, 16, 3), dtype=np.uint8), seed=0,
+                                   effect_type_seq=tuple(range(len(EFFECT_NAMES))))
+    return os.getpid()
+
+
+def _decode_upload(data: bytes) -> Union[Image.Image, np.ndarray]:
+    """
+     Opens an uploaded image. Palette and grayscale images, e.g. single frame GIFs, are turned
+     into RGB or RGBA pixels, as the effects and GifWriter work on color channels
+     Animated images are left as they are, for the glitcher to reject
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.mode in ('RGB', 'RGBA') or getattr(img, 'is_animated', False):
+        return img
+    alpha = img.mode in ('LA', 'PA') or 'transparency' in img.info
+    return np.asarray(img.convert('RGBA' if alpha else 'RGB'))
+
+
+def _render_job(data: bytes, effect_type_seq, seed, frames: int, step: int, preview: int) -> Tuple[bytes, str]:
+    # Runs in a worker, returns the encoded result and its content type
+    img = _decode_upload(data)
+    buffer = io.BytesIO()
+    if preview:
+        glitch_frames = list(_service_glitcher.iter_preview_frames(img, seed=seed, frames=frames, step=step,
+                                                                   effect_type_seq=effect_type_seq,
+                                                                   max_size=preview))
+        if frames == 1:
+            glitch_frames[0].save(buffer, format='PNG')
+            return buffer.getvalue(), 'image/png'
+        with GifWriter(buffer, palette=glitch_frames[0]) as writer:
+            for frame in glitch_frames:
+                writer.write(frame)
+        return buffer.getvalue(), 'image/gif'
+    if frames == 1:
+        _service_glitcher.glitch_image(img, seed=seed, effect_type_seq=effect_type_seq).save(buffer, format='PNG')
+        return buffer.getvalue(), 'image/png'
+    with GifWriter(buffer, palette=img) as writer:
+        for frame in _service_glitcher.iter_glitch_frames(img, seed=seed, frames=frames, step=step,
+                                                          effect_type_seq=effect_type_seq):
+            writer.write(frame)
+    return buffer.getvalue(), 'image/gif'
+
+
+def parse_render_params(query: str):
+    """
+     Parses the query string of a render request into (effect_type_seq, seed, frames, step, preview)
+     preview is the longest side of the proxy resolution, 0 for a full resolution render
+     seed is None without a seed or for seed=0, which the glitcher does not take as a seed either
+     Raises ValueError for missing or invalid values
+    """
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    try:
+        effect_type_seq = tuple(int(i) for i in params.get('effects', '').split(',') if i)
+        seed = (int(params['seed']) or None) if 'seed' in params else None
+        frames = int(params.get('frames', 23))
+        step = int(params.get('step', 1))
+        preview = int(params.get('preview', 0))
+    except ValueError:
+        raise ValueError('effects must be a comma separated list of integers, seed, frames, step and preview integers')
+    if not effect_type_seq:
+        raise ValueError('effects param is required, e.g. effects=10,1')
+    if not all(0 <= i < len(EFFECT_NAMES) for i in effect_type_seq):
+        raise ValueError(f'effects must be in [0, {len(EFFECT_NAMES) - 1}]')
+    if frames < 1 or step < 1:
+        raise ValueError('frames and step params must be positive integers')
+    if preview < 0:
+        raise ValueError('preview param must be a non-negative integer')
+    return effect_type_seq, seed, frames, step, preview
+
+
+class RenderService:
+    """
+     Renders requests on a pool of warm worker processes
+     workers: Number of worker processes, defaults to the number of cores
+     cache_mb: Size of the in-memory LRU of recent results
+    """
+
+    def __init__(self, workers: Optional[int] = None, cache_mb: float = DEFAULT_CACHE_MB):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_bytes = int(cache_mb * 2 ** 20)
+        self.pool = None
+        # key -> (body, content type), least recently used first
+        self.__cache = OrderedDict()
+        self.__cached_bytes = 0
+        # key -> future of the render in flight
+        self.__inflight = {}
+        self.counters = {'requests': 0, 'renders': 0, 'cache_hits': 0, 'coalesced': 0, 'errors': 0,
+                         'pool_restarts': 0}
+
+    async def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_service_worker)
+        loop = asyncio.get_running_loop()
+        # Concurrent warm up jobs make the pool start all of its processes right away
+        await asyncio.gather(*(loop.run_in_executor(self.pool, _warm_up) for _ in range(self.workers)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def stats(self) -> dict:
+        return dict(self.counters, workers=self.workers, inflight=len(self.__inflight),
+                    cached=len(self.__cache), cached_bytes=self.__cached_bytes)
+
+    async def render(self, data: bytes, effect_type_seq, seed=None, frames: int = 23,
+                     step: int = 1, preview: int = 0) -> Tuple[bytes, str]:
+        """
+         Returns (encoded result, content type), from the cache, from an identical request
+         in flight, or rendered by the pool
+        """
+        if not seed:
+            self.counters['renders'] += 1
+            return await self.__run(data, effect_type_seq, seed, frames, step, preview)
+
+        key = (hashlib.sha256(data).digest(), tuple(effect_type_seq), seed, frames, step, preview)
+        if key in self.__cache:
+            self.__cache.move_to_end(key)
+            self.counters['cache_hits'] += 1
+            return self.__cache[key]
+        if key in self.__inflight:
+            self.counters['coalesced'] += 1
+            # Shielded, so a client that goes away does not cancel the render of the others
+            return await asyncio.shield(self.__inflight[key])
+
+        self.counters['renders'] += 1
+        future = asyncio.ensure_future(self.__run(data, effect_type_seq, seed, frames, step, preview))
+        self.__inflight[key] = future
+        try:
+            result = await asyncio.shield(future)
+        finally:
+            del self.__inflight[key]
+        self.__store(key, result)
+        return result
+
+    async def __run(self, *job) -> Tuple[bytes, str]:
+        # Renders on the pool. A worker that dies, e.g. out of memory, breaks the whole pool: it is
+        # replaced by a new one for the next requests, only the jobs that were on it fail
+        pool = self.pool
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, _render_job, *job)
+        except BrokenProcessPool:
+            # The first of the failed jobs restarts the pool, the others find it replaced
+            if self.pool is pool:
+                self.counters['pool_restarts'] += 1
+                pool.shutdown(wait=False, cancel_futures=True)
+                await self.start()
+            raise
+
+    def __store(self, key, result):
+        size = len(result[0])
+        if size > self.cache_bytes:
+            return
+        self.__cache[key] = result
+        self.__cached_bytes += size
+        while self.__cached_bytes > self.cache_bytes:
+            _, (body, _) = self.__cache.popitem(last=False)
+            self.__cached_bytes -= len(body)
+
+    async def __dispatch(self, method: str, target: str, body: bytes) -> Tuple[int, str, bytes]:
+        url = urlsplit(target)
+        if url.path == '/stats':
+            if method != 'GET':
+                return 405, 'text/plain', b'Use GET'
+            return 200, 'application/json', json.dumps(self.stats()).encode()
+        if url.path != '/render':
+            return 404, 'text/plain', b'Unknown path, use /render or /stats'
+        if method != 'POST':
+            return 405, 'text/plain', b'Use POST with the image as the body'
+
+        try:
+            effect_type_seq, seed, frames, step, preview = parse_render_params(url.query)
+        except ValueError as e:
+            return 400, 'text/plain', str(e).encode()
+        if not body:
+            return 400, 'text/plain', b'The request body must be the image file'
+        try:
+            result, content_type = await self.render(body, effect_type_seq, seed, frames, step, preview)
+        except BrokenProcessPool:
+            # A worker died during the render, the pool is already replaced for the next requests
+            raise
+        except Exception as e:
+            # The image could not be decoded or glitched
+            self.counters['errors'] += 1
+            return 422, 'text/plain', str(e).encode()
+        return 200, content_type, result
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+         Serves the HTTP/1.1 requests of one connection, which is kept alive between them
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                length = int(headers.get('content-length', 0))
+                self.counters['requests'] += 1
+                if length > MAX_BODY_BYTES:
+                    status, content_type, payload = 413, 'text/plain', b'Image too large'
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    try:
+                        status, content_type, payload = await self.__dispatch(method, target, body)
+                    except Exception as e:
+                        self.counters['errors'] += 1
+                        status, content_type, payload = 500, 'text/plain', repr(e).encode()
+
+                writer.write((f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                              f'Content-Type: {content_type}\r\n'
+                              f'Content-Length: {len(payload)}\r\n'
+                              f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n').encode('latin-1'))
+                writer.write(payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Client went away or sent something that is not HTTP
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host: str = '127.0.0.1', port: int = DEFAULT_PORT, unix: Optional[str] = None,
+                workers: Optional[int] = None, cache_mb: float = DEFAULT_CACHE_MB):
+    service = RenderService(workers=workers, cache_mb=cache_mb)
+    await service.start()
+    try:
+        if unix:
+            server = await asyncio.start_unix_server(service.handle, path=unix)
+            address = unix
+        else:
+            server = await asyncio.start_server(service.handle, host=host, port=port)
+            address = f'http://{host}:{port}'
+        print(f'serving on {address} with {service.workers} workers', file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local glitch render service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', metavar='PATH', help='Listen on a Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, help='Worker processes, defaults to the number of cores')
+    parser.add_argument('--cache-mb', type=float, default=DEFAULT_CACHE_MB,
+                        help='Size of the LRU of recent results (default: %(default)s)')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.cache_mb))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Instrumentation of the glitcher
+# Pass a GlitchStats as ImageGlitcher(stats=...) (and to write_frames) to find out where
+# the time of a job goes. Without one, the glitcher only pays for a few `is None` checks
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+
+class Event(NamedTuple):
+    name: str
+    # effect, draw, remap, decode, encode, copy or job
+    category: str
+    # perf_counter() seconds
+    start: float
+    duration: float
+    # Peak bytes allocated during the stage, 0 unless memory is measured
+    nbytes: int
+    frame: Optional[int]
+
+
+class GlitchStats:
+    """
+     Collects the timings of a glitcher
+     Aggregates (count, total and max time, peak bytes) per stage name are always kept,
+     which is cheap enough to leave on for every job
+     trace: Also keep every single event, for write_chrome_trace
+     memory: Also measure the peak bytes allocated by every effect with tracemalloc,
+             which slows every allocation down, so only use it when looking for copies
+     callback: Called with every Event as soon as it is recorded
+    """
+
+    def __init__(self, trace: bool = False, memory: bool = False,
+                 callback: Optional[Callable[[Event], None]] = None):
+        self.trace = trace
+        self.memory = memory
+        self.callback = callback
+        self.frames = 0
+        # name -> [count, total seconds, max seconds, max bytes]
+        self.totals: Dict[str, List] = {}
+        self.events: List[Event] = []
+        self.origin = time.perf_counter()
+        self.__lock = threading.Lock()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def begin(self, measure_bytes: bool = False):
+        """
+         Starts timing a stage, pass the returned token to end()
+         Only innermost stages should measure bytes, as measuring resets the peak
+        """
+        if self.memory and measure_bytes:
+            tracemalloc.reset_peak()
+            return time.perf_counter(), tracemalloc.get_traced_memory()[0]
+        return time.perf_counter(), None
+
+    def end(self, name: str, token, category: str = 'effect', frame: Optional[int] = None):
+        start, base = token
+        duration = time.perf_counter() - start
+        nbytes = tracemalloc.get_traced_memory()[1] - base if base is not None else 0
+        event = Event(name, category, start, duration, nbytes, frame)
+        with self.__lock:
+            total = self.totals.get(name)
+            if total is None:
+                self.totals[name] = [1, duration, duration, nbytes]
+            else:
+                total[0] += 1
+                total[1] += duration
+                total[2] = max(total[2], duration)
+                total[3] = max(total[3], nbytes)
+            if self.trace:
+                self.events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+
+    @contextmanager
+    def span(self, name: str, category: str = 'job', frame: Optional[int] = None):
+        token = self.begin()
+        try:
+            yield
+        finally:
+            self.end(name, token, category, frame)
+
+    def count_frame(self):
+        with self.__lock:
+            self.frames += 1
+
+    def reset(self):
+        with self.__lock:
+            self.frames = 0
+            self.totals.clear()
+            self.events.clear()
+            self.origin = time.perf_counter()
+
+    def as_dict(self) -> dict:
+        return {
+            'frames': self.frames,
+            'stages': {name: {'count': count, 'total_ms': total * 1000, 'mean_ms': total / count * 1000,
+                              'max_ms': longest * 1000, 'peak_bytes': nbytes}
+                       for name, (count, total, longest, nbytes) in self.totals.items()},
+        }
+
+    def summary(self) -> str:
+        """
+         One line per stage, slowest total first
+        """
+        lines = [f'{self.frames} frames']
+        for name, (count, total, longest, nbytes) in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+            line = (f'{name:>40}: {count:6d} x {total / count * 1000:9.2f} ms = {total * 1000:10.1f} ms, '
+                    f'max {longest * 1000:9.2f} ms')
+            if self.memory:
+                line += f', peak {nbytes / 2 ** 20:8.1f} MB'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def write_chrome_trace(self, path: str):
+        """
+         Writes the events in the Chrome trace event format, open it in chrome://tracing or Perfetto
+        """
+        if not self.trace:
+            raise ValueError('Events are only kept by GlitchStats(trace=True)')
+        pid = os.getpid()
+        events = []
+        for event in self.events:
+            args = {'bytes': event.nbytes}
+            if event.frame is not None:
+                args['frame'] = event.frame
+            events.append({
+                'name': event.name,
+                'cat': event.category,
+                'ph': 'X',
+                'ts': (event.start - self.origin) * 1e6,
+                'dur': event.duration * 1e6,
+                'pid': pid,
+                'tid': 0,
+                'args': args,
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
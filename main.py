@@ -1,46 +1,208 @@
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from frame_writer import write_frames
 from glitch_effect import ImageGlitcher
 
 
-def gen_all_single_effects_of_all_image(img_path="pics", out_path="result"):
+# Frames of every rendered GIF, as the cache keys need them
+GIF_FRAMES = 23
+GIF_STEP = 1
+
+
+def replace_output(path):
+    """
+     Temporary path to render path into, move it over path with os.replace once complete
+     Outputs may be hard links into a RenderCache, so they must never be rewritten in place
+    """
+    root, ext = os.path.splitext(path)
+    return root + '.partial' + ext
+
+
+def render_gif(src_path, path, effect_type_seq, seed=None, cache=None, stats=None):
+    """
+     Renders the glitched GIF of src_path into path, or links it from the cache when
+     the same source was already rendered with the same parameters
+     Returns False when the output came from the cache
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(src_path, effect_type_seq, seed=seed, frames=GIF_FRAMES, step=GIF_STEP,
+                        ext='.gif', duration=200, loop=0)
+        if cache.fetch(key, path):
+            return False
+
+    glitcher = ImageGlitcher(stats=stats)
+    # Frames are encoded as they are rendered instead of being collected first
+    glitch_frames = glitcher.iter_glitch_frames(src_path, seed=seed, frames=GIF_FRAMES, step=GIF_STEP,
+                                                effect_type_seq=effect_type_seq)
+    partial = replace_output(path)
+    # One palette from the source for all frames, which only store what changed
+    write_frames(glitch_frames, partial, duration=200, loop=0, stats=stats, palette=Image.open(src_path))
+    os.replace(partial, path)
+    if cache is not None:
+        cache.store(key, path)
+    return True
+
+
+def gen_all_single_effects_of_all_image(img_path="pics", out_path="result", seed=None, cache=None):
+    """
+     cache: A RenderCache, outputs that did not change since they were cached are not rendered again
+    """
     src_images = [f for f in os.listdir(img_path)
                   if os.path.isfile(os.path.join(img_path, f)) and not f.startswith('.')]
 
     for src_image in src_images:
         for effect_i in range(11):
             print('processing ', os.path.join(img_path, src_image), "effect =", effect_i)
-            glitcher = ImageGlitcher()
-            glitch_img = glitcher.glitch_image(os.path.join(img_path, src_image), gif=True,
-                                               effect_type_seq=(effect_i,))
-            glitch_img[0].save(os.path.join(out_path, src_image.split('.')[0] + '_' + str(effect_i) + '.gif'),
-                               format='GIF',
-                               append_images=glitch_img[1:],
-                               save_all=True,
-                               duration=200,
-                               loop=0,
-                               compress_level=3)
-
-
-def gen_stacked_effects_of_all_image(img_path="pics", out_path="result", effect_type_seq=(10,)):
+            if not render_gif(os.path.join(img_path, src_image),
+                              os.path.join(out_path, src_image.split('.')[0] + '_' + str(effect_i) + '.gif'),
+                              (effect_i,), seed=seed, cache=cache):
+                print('unchanged, linked from cache')
+    if cache is not None:
+        cache.evict()
+
+
+def gen_stacked_effects_of_all_image(img_path="pics", out_path="result", effect_type_seq=(10,), stats=None,
+                                     seed=None, cache=None):
     src_images = [f for f in os.listdir(img_path)
                   if os.path.isfile(os.path.join(img_path, f)) and not f.startswith('.')]
 
     for src_image in src_images:
         print('processing ', os.path.join(img_path, src_image), ", effects =",
               ','.join([str(i) for i in effect_type_seq]))
-        glitcher = ImageGlitcher()
-        glitch_img = glitcher.glitch_image(os.path.join(img_path, src_image), gif=True,
-                                           effect_type_seq=effect_type_seq)
-        glitch_img[0].save(
-            os.path.join(out_path, src_image.split('.')[0] + '_' + '_'.join([str(k) for k in effect_type_seq]) + '.gif'),
-            format='GIF',
-            append_images=glitch_img[1:],
-            save_all=True,
-            duration=200,
-            loop=0,
-            compress_level=3)
+        if not render_gif(os.path.join(img_path, src_image),
+                          os.path.join(out_path, src_image.split('.')[0] + '_' +
+                                       '_'.join([str(k) for k in effect_type_seq]) + '.gif'),
+                          effect_type_seq, seed=seed, cache=cache, stats=stats):
+            print('unchanged, linked from cache')
+    if cache is not None:
+        cache.evict()
+    if stats is not None:
+        print(stats.summary())
+
+
+def gen_preview(src_path, out_path, effect_type_seq=(10,), seed=None, max_size=512):
+    """
+     Renders a quick low resolution GIF of src_path for tuning effect_type_seq
+     Returns the seed, render_gif with the same seed gives the full resolution output
+    """
+    glitcher = ImageGlitcher()
+    glitch_frames = list(glitcher.iter_preview_frames(src_path, seed=seed, frames=GIF_FRAMES, step=GIF_STEP,
+                                                      effect_type_seq=effect_type_seq, max_size=max_size))
+    write_frames(glitch_frames, out_path, duration=200, loop=0, palette=glitch_frames[0])
+    print('preview of', src_path, 'saved to', out_path, 'with seed', glitcher.seed)
+    return glitcher.seed
+
+
+def gen_glitched_animation(src_path, out_path, effect_type_seq=(10,), seed=None):
+    """
+     Glitches every frame of an animated GIF/APNG and streams them into out_path (.gif or .png)
+     Source frames are decoded one at a time and keep their duration and loop count
+    """
+    print('processing ', src_path, ", effects =", ','.join([str(i) for i in effect_type_seq]))
+    glitcher = ImageGlitcher()
+    src_img = Image.open(src_path)
+    glitch_frames = glitcher.iter_glitch_animation(src_img, seed=seed, effect_type_seq=effect_type_seq)
+    write_frames(glitch_frames, out_path, loop=src_img.info.get('loop', 0))
+
+
+# Long-lived glitcher and attached shared memory of a batch worker process
+_batch_glitcher = None
+_batch_sources = {}
+
+
+def _init_batch_worker():
+    global _batch_glitcher
+    _batch_glitcher = ImageGlitcher()
+
+
+def _render_batch_job(shm_name, shape, effect_type_seq, path, seed):
+    # Attach to the decoded source once per process, the pixels are never copied between processes
+    if shm_name not in _batch_sources:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _batch_sources[shm_name] = (shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf))
+    _, src = _batch_sources[shm_name]
+
+    glitch_frames = _batch_glitcher.iter_glitch_frames(src, seed=seed, frames=GIF_FRAMES, step=GIF_STEP,
+                                                       effect_type_seq=effect_type_seq)
+    partial = replace_output(path)
+    write_frames(glitch_frames, partial, duration=200, loop=0, palette=src)
+    os.replace(partial, path)
+    return path
+
+
+def decode_image(path):
+    # Same modes as ImageGlitcher uses when it opens a path itself
+    img = Image.open(path)
+    return np.asarray(img.convert('RGBA' if path.endswith('.png') else 'RGB'))
+
+
+def gen_batch_effects_of_all_image(img_path="pics", out_path="result",
+                                   effect_type_seqs=tuple((i,) for i in range(11)),
+                                   max_workers=None, seed=None, cache=None):
+    """
+     Renders every effect sequence for every image on a pool of at most max_workers processes
+     (defaults to the number of cores)
+     Every source is decoded once into shared memory and read from there by all the jobs
+     cache: A RenderCache, outputs found in it are linked instead of rendered, and sources
+            whose outputs are all cached are not even decoded
+    """
+    src_images = [f for f in os.listdir(img_path)
+                  if os.path.isfile(os.path.join(img_path, f)) and not f.startswith('.')]
+
+    sources = []
+    try:
+        jobs = []
+        # Output path -> cache key of the jobs that have to be stored once rendered
+        keys = {}
+        for src_image in src_images:
+            src_path = os.path.join(img_path, src_image)
+            pending = []
+            for effect_type_seq in effect_type_seqs:
+                path = os.path.join(out_path, src_image.split('.')[0] + '_' +
+                                    '_'.join([str(k) for k in effect_type_seq]) + '.gif')
+                if cache is not None:
+                    key = cache.key(src_path, effect_type_seq, seed=seed, frames=GIF_FRAMES, step=GIF_STEP,
+                                    ext='.gif', duration=200, loop=0)
+                    if cache.fetch(key, path):
+                        print('unchanged, linked from cache', path)
+                        continue
+                    keys[path] = key
+                pending.append((tuple(effect_type_seq), path))
+            if not pending:
+                continue
+
+            arr = decode_image(src_path)
+            shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+            sources.append(shm)
+            np.ndarray(arr.shape, dtype=np.uint8, buffer=shm.buf)[...] = arr
+            for effect_type_seq, path in pending:
+                jobs.append((shm.name, arr.shape, effect_type_seq, path, seed))
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_batch_worker) as pool:
+            futures = [pool.submit(_render_batch_job, *job) for job in jobs]
+            for done, future in enumerate(as_completed(futures), 1):
+                path = future.result()
+                if cache is not None:
+                    cache.store(keys[path], path)
+                print('[%d/%d] saved' % (done, len(jobs)), path)
+        if cache is not None:
+            cache.evict()
+    finally:
+        for shm in sources:
+            shm.close()
+            shm.unlink()
 
 
 if __name__ == '__main__':
     # gen_all_single_effects_of_all_image()
+    # gen_batch_effects_of_all_image()
+    # Nightly re-renders: skip everything that did not change since the last run
+    # (RenderCache from render_cache)
+    # gen_all_single_effects_of_all_image(seed=580, cache=RenderCache(max_bytes=2 ** 30, max_age_days=30))
     gen_stacked_effects_of_all_image()
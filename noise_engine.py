@@ -0,0 +1,122 @@
+# Additive analog noise on uint8 frames
+# Noise is drawn as float32 from a numpy Generator, turned into uint8 once and added
+# with saturation, all in buffers that are reused from frame to frame
+
+from typing import Callable, Optional
+
+import numpy as np
+
+
+class NoiseEngine:
+    """
+     Adds clip(N(mean, stddev), 0, 255) noise to uint8 pixels, saturating at 255
+     tiles: Number of pre-generated noise tiles to sample from, 0 draws exact noise
+            for every pixel of every frame. With a pool, the noise of a frame is built
+            from views into the tiles at random offsets and flips, so a frame costs
+            little more than the saturating add itself
+     tile_size: Edge length of the pieces a frame is split into when sampling the pool
+    """
+
+    def __init__(self, tiles: int = 0, tile_size: int = 256):
+        if not (isinstance(tiles, int) and tiles >= 0):
+            raise ValueError('tiles param must be a non-negative integer')
+        if not (isinstance(tile_size, int) and tile_size > 0):
+            raise ValueError('tile_size param must be a positive integer value greater than 0')
+        self.tiles = tiles
+        self.tile_size = tile_size
+        # Buffers of the exact noise of one frame
+        self.__gauss = None
+        self.__noise = None
+        # Tile pool and the (seed, channels, mean, stddev) it was drawn for
+        self.__pool = None
+        self.__pool_key = None
+
+    def add(self, src: np.ndarray, dst: np.ndarray, rng: np.random.Generator,
+            mean=0, stddev=50, pool_seed: Optional[int] = None):
+        """
+         Writes src plus noise into dst, src and dst are uint8 arrays of the same shape
+         rng draws the noise of this frame, pool_seed the tile pool when tiles are used
+        """
+        self.plan(rng, src.shape, mean, stddev, pool_seed)(src, dst, 0)
+
+    def plan(self, rng: np.random.Generator, shape, mean=0, stddev=50,
+             pool_seed: Optional[int] = None, any_order: bool = False) -> Callable[[np.ndarray, np.ndarray, int], None]:
+        """
+         Sets up the noise of a frame of the given shape and returns add(src, dst, row_start),
+         which writes rows [row_start, row_start + len(src)) of the frame plus noise into dst
+         Adding the frame band by band gives the same pixels as adding it at once, as long as
+         the bands come in row order (exact noise is drawn from rng as the rows come)
+         any_order: Draw the exact noise of the whole frame right away instead, so bands can
+                    be added in any order, or from several threads at once
+        """
+        if not self.tiles:
+            if any_order:
+                noise = self.__draw(rng, shape, mean, stddev)
+
+                def add(src, dst, row_start):
+                    self.__saturating_add(src, noise[row_start:row_start + len(src)], dst)
+                return add
+
+            def add(src, dst, row_start):
+                self.__saturating_add(src, self.__draw(rng, src.shape, mean, stddev), dst)
+            return add
+
+        height, width, channels = shape
+        size = self.tile_size
+        key = (pool_seed, channels, mean, stddev)
+        if self.__pool_key != key:
+            # Tiles are twice the piece size so any offset in [0, size) gives a full piece
+            pool_rng = np.random.default_rng(pool_seed)
+            self.__pool = np.empty((self.tiles, 2 * size, 2 * size, channels), dtype=np.uint8)
+            for tile in self.__pool:
+                tile[...] = self.__draw(pool_rng, tile.shape, mean, stddev)
+            self.__gauss = self.__noise = None
+            self.__pool_key = key
+
+        cols = range(0, width, size)
+        grid = ((height + size - 1) // size, len(cols))
+        picks = rng.integers(self.tiles, size=grid)
+        offsets = rng.integers(size, size=grid + (2,))
+        flips = rng.integers(2, size=grid + (2,)).astype(bool)
+
+        def add(src, dst, row_start):
+            row_stop = row_start + len(src)
+            for i in range(row_start // size, (row_stop + size - 1) // size):
+                y = i * size
+                h = min(size, height - y)
+                # Rows of this piece that fall into the band
+                top, bottom = max(y, row_start) - y, min(y + h, row_stop) - y
+                band = slice(y + top - row_start, y + bottom - row_start)
+                for j, x in enumerate(cols):
+                    w = min(size, width - x)
+                    oy, ox = offsets[i, j]
+                    piece = self.__pool[picks[i, j], oy:oy + h, ox:ox + w]
+                    if flips[i, j, 0]:
+                        piece = piece[::-1]
+                    if flips[i, j, 1]:
+                        piece = piece[:, ::-1]
+                    self.__saturating_add(src[band, x:x + w], piece[top:bottom], dst[band, x:x + w])
+
+        return add
+
+    def __draw(self, rng: np.random.Generator, shape, mean, stddev) -> np.ndarray:
+        # clip(N(mean, stddev), 0, 255) truncated to uint8, like the float noise
+        # the effect used to add before casting the sum back to uint8
+        if self.__noise is None or self.__noise.shape != shape:
+            self.__gauss = np.empty(shape, dtype=np.float32)
+            self.__noise = np.empty(shape, dtype=np.uint8)
+        rng.standard_normal(dtype=np.float32, out=self.__gauss)
+        self.__gauss *= stddev
+        if mean:
+            self.__gauss += mean
+        np.clip(self.__gauss, 0, 255, out=self.__gauss)
+        self.__noise[...] = self.__gauss
+        return self.__noise
+
+    @staticmethod
+    def __saturating_add(src: np.ndarray, noise: np.ndarray, dst: np.ndarray):
+        # dst = min(src + noise, 255) in uint8: the noise is first limited to the
+        # headroom 255 - src, so the sum can never wrap around
+        np.subtract(255, src, out=dst)
+        np.minimum(dst, noise, out=dst)
+        dst += src
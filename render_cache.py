@@ -0,0 +1,143 @@
+# Content addressed cache of rendered outputs
+# An output is stored under a hash of everything it depends on: the source bytes, the
+# render parameters and the code of the effects and encoders. Re-rendering an unchanged
+# catalog then only hashes the sources and links the cached files into place
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Dict, Optional, Tuple
+
+# Modules whose code decides the pixels and bytes of an output
+VERSIONED_MODULES = ('glitch_effect', 'noise_engine', 'frame_writer')
+
+
+def effects_version() -> str:
+    """
+     Hash of the code of VERSIONED_MODULES, any change to them invalidates the whole cache
+    """
+    digest = hashlib.sha256()
+    for name in VERSIONED_MODULES:
+        module = __import__(name)
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """
+     Cache directory of rendered files, named by the hash of their inputs
+     Hits are hard-linked to the output path (copied where links are not possible)
+     max_bytes: Total size the cache is trimmed to by evict(), least recently used first
+     max_age_days: Entries not used for longer are removed by evict()
+    """
+
+    def __init__(self, root: str = '.render_cache', max_bytes: Optional[int] = None,
+                 max_age_days: Optional[float] = None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.version = effects_version()
+        # (path, size, mtime) -> hash, every source is read once per cache object
+        self.__source_hashes: Dict[Tuple[str, int, int], str] = {}
+        os.makedirs(root, exist_ok=True)
+
+    def source_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if stamp not in self.__source_hashes:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.__source_hashes[stamp] = digest.hexdigest()
+        return self.__source_hashes[stamp]
+
+    def key(self, src_path: str, effect_type_seq, seed=None, frames: int = 23, step: int = 1,
+            ext: str = '.gif', **params) -> str:
+        """
+         Cache key of rendering src_path with the given parameters into an ext file
+         Unseeded renders are keyed with seed None, so a cached random render is reused
+         params: Any other setting the output depends on, e.g. duration
+        """
+        description = json.dumps({
+            'source': self.source_hash(src_path),
+            'effects': list(effect_type_seq),
+            'seed': seed,
+            'frames': frames,
+            'step': step,
+            'ext': ext,
+            'params': params,
+            'version': self.version,
+        }, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest() + ext
+
+    def __entry(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key: str, out_path: str) -> bool:
+        """
+         Puts the cached output of key at out_path, returns False on a miss
+         An out_path that already is the cached file is left alone
+        """
+        entry = self.__entry(key)
+        if not os.path.isfile(entry):
+            return False
+        # Mark the entry as recently used for eviction
+        os.utime(entry)
+        if os.path.exists(out_path):
+            if os.path.samefile(entry, out_path):
+                return True
+            os.remove(out_path)
+        self.__link(entry, out_path)
+        return True
+
+    def store(self, key: str, rendered_path: str):
+        """
+         Adds a rendered file to the cache
+         The file must not be rewritten in place afterwards, as it may share its data with
+         the cache entry: replace it with a new file instead (write elsewhere, os.replace)
+        """
+        entry = self.__entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = f'{entry}.{os.getpid()}.tmp'
+        self.__link(rendered_path, tmp)
+        os.replace(tmp, entry)
+
+    @staticmethod
+    def __link(src: str, dst: str):
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Other file system, or links are not supported
+            shutil.copy2(src, dst)
+
+    def evict(self) -> int:
+        """
+         Removes entries older than max_age_days, then the least recently used ones until the
+         cache fits in max_bytes. Outputs linked from removed entries stay where they are
+         Returns the number of removed entries
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.root, '??', '*')):
+            if path.endswith('.tmp'):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        removed = 0
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            expired = self.max_age_days is not None and now - mtime > self.max_age_days * 86400
+            oversize = self.max_bytes is not None and total > self.max_bytes
+            if not (expired or oversize):
+                continue
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,123 @@
+# Load generator for glitch_service.py
+# Sends render requests from a number of concurrent keep-alive connections and reports the
+# latency percentiles. Requests cycle through a few seeds, so with more requests than seeds
+# the cache and the merging of identical requests in flight get exercised as well
+#   python glitch_service.py &
+#   python service_load.py -i pics/gta.jpg --requests 200 --concurrency 8
+
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from typing import List, Optional, Tuple
+
+
+async def http_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, target: str,
+                       body: bytes = b'') -> Tuple[int, bytes]:
+    """
+     Sends one request on a kept alive connection and returns (status, body)
+    """
+    writer.write((f'{method} {target} HTTP/1.1\r\nHost: localhost\r\n'
+                  f'Content-Length: {len(body)}\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def connect(host: str, port: int, unix: Optional[str]):
+    if unix:
+        return await asyncio.open_unix_connection(unix)
+    return await asyncio.open_connection(host, port)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    # Nearest rank percentile
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+async def run_load(images: List[bytes], effects: str, frames: int, seeds: int, requests: int, concurrency: int,
+                   host: str, port: int, unix: Optional[str]) -> dict:
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait((images[i % len(images)], f'/render?effects={effects}&frames={frames}&seed={i % seeds + 1}'))
+    latencies = []
+    errors = 0
+
+    async def client():
+        nonlocal errors
+        reader, writer = await connect(host, port, unix)
+        try:
+            while not queue.empty():
+                body, target = queue.get_nowait()
+                start = time.perf_counter()
+                status, _ = await http_request(reader, writer, 'POST', target, body)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await connect(host, port, unix)
+    _, server_stats = await http_request(reader, writer, 'GET', '/stats')
+    writer.close()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'server': json.loads(server_stats),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test a running glitch_service.py')
+    parser.add_argument('-i', '--images', nargs='+', required=True, help='Images to send')
+    parser.add_argument('-e', '--effects', default='10', help='Comma separated effect indices (default: 10)')
+    parser.add_argument('--frames', type=int, default=23)
+    parser.add_argument('--seeds', type=int, default=4, help='Distinct seeds the requests cycle through')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8580)
+    parser.add_argument('--unix', metavar='PATH', help='Connect to a Unix socket instead of TCP')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    images = []
+    for path in args.images:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    report = asyncio.run(run_load(images, args.effects, args.frames, args.seeds, args.requests,
+                                  args.concurrency, args.host, args.port, args.unix))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['requests']} requests, {report['errors']} errors in {report['seconds']:.2f} s "
+          f"({report['requests_per_second']:.1f} req/s)")
+    print(f"latency p50 {report['p50_ms']:.1f} ms, p90 {report['p90_ms']:.1f} ms, "
+          f"p99 {report['p99_ms']:.1f} ms, max {report['max_ms']:.1f} ms")
+    print('server', json.dumps(report['server']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# Renders one animation across several machines
+# Frame k of an animation only depends on the seed and k, so any range of frames can be
+# rendered on its own. Every node renders a shard of frames into an intermediate .npz file,
+# merge then streams the shards in frame order into the final GIF or APNG
+#   python shard_render.py plan --frames 400 --shards 4
+#   python shard_render.py render pics/gta.jpg --seed 580 --frames 400 -e 8 10 --frame-range 0:100 -o gta_0.npz
+#   python shard_render.py merge gta_*.npz -o gta.gif
+import argparse
+import hashlib
+import json
+import sys
+import zipfile
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from frame_writer import write_frames
+from glitch_effect import ImageGlitcher
+from main import decode_image
+from render_cache import effects_version
+
+# Deflate level of the frames in a shard, low levels cost little time and still
+# shrink glitched frames a lot
+SHARD_COMPRESS_LEVEL = 1
+
+
+def parse_frame_range(text: str, frames: int) -> Tuple[int, int]:
+    """
+     Parses START:STOP (STOP excluded, either may be left out) into a range within [0, frames)
+    """
+    start, sep, stop = text.partition(':')
+    if not sep:
+        raise ValueError(f'frame range must be START:STOP, got {text!r}')
+    start = int(start) if start else 0
+    stop = int(stop) if stop else frames
+    if not 0 <= start < stop <= frames:
+        raise ValueError(f'frame range {text!r} must be within [0, {frames}) and not empty')
+    return start, stop
+
+
+def plan_shards(frames: int, shards: int) -> List[Tuple[int, int]]:
+    # Ranges of about the same number of frames covering [0, frames)
+    if frames < 1 or shards < 1:
+        raise ValueError('frames and shards must be positive integers')
+    shards = min(shards, frames)
+    edges = [frames * k // shards for k in range(shards + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def render_shard(src_path: str, out_path: str, seed: int, frames: int, frame_range: Tuple[int, int],
+                 effect_type_seq: Sequence[int], step: int = 1, noise_tiles: int = 0, threads: int = 1):
+    """
+     Renders frames [start, stop) of the frames-long animation of src_path into the shard out_path
+     A shard is a .npz archive of frame_<k>.npy arrays, the source pixels and meta.json,
+     frames that are not glitched (k % step != 0) are left to the source
+    """
+    if not seed:
+        raise ValueError('seed param is required, shards without one would not fit together')
+    with open(src_path, 'rb') as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()
+    src = decode_image(src_path)
+    start, stop = frame_range
+    meta = {
+        'source': source_hash,
+        'seed': seed,
+        'frames': frames,
+        'step': step,
+        'effects': list(effect_type_seq),
+        'noise_tiles': noise_tiles,
+        'version': effects_version(),
+        'range': [start, stop],
+        'shape': list(src.shape),
+    }
+
+    glitcher = ImageGlitcher(noise_tiles=noise_tiles, threads=threads)
+    with zipfile.ZipFile(out_path, 'w', compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=SHARD_COMPRESS_LEVEL) as shard:
+        shard.writestr('meta.json', json.dumps(meta))
+        with shard.open('source.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, src)
+        for k in range(start, stop):
+            if k % step != 0:
+                continue
+            frame = glitcher.glitch_array(src, frame_index=k, effect_type_seq=effect_type_seq, seed=seed)
+            # Frames are streamed into the archive, a shard never holds more than one in memory
+            with shard.open(f'frame_{k:06d}.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, frame)
+            print(f'rendered frame {k} of [{start}, {stop})', file=sys.stderr)
+    glitcher.close()
+
+
+def read_meta(path: str) -> dict:
+    with zipfile.ZipFile(path) as shard:
+        return json.loads(shard.read('meta.json'))
+
+
+def check_shards(metas: List[dict], paths: List[str]):
+    """
+     Raises ValueError unless the shards belong to the same animation and cover
+     every one of its frames exactly once
+    """
+    keys = ('source', 'seed', 'frames', 'step', 'effects', 'noise_tiles', 'version', 'shape')
+    first = metas[0]
+    for meta, path in zip(metas, paths):
+        different = [key for key in keys if meta[key] != first[key]]
+        if different:
+            raise ValueError(f'{path} does not belong to the animation of {paths[0]}, '
+                             f'different {", ".join(different)}')
+    expected = 0
+    for meta, path in sorted(zip(metas, paths), key=lambda item: item[0]['range'][0]):
+        start, stop = meta['range']
+        if start != expected:
+            problem = 'overlaps the previous shard' if start < expected else f'leaves frames [{expected}, {start}) out'
+            raise ValueError(f'{path} with frames [{start}, {stop}) {problem}')
+        expected = stop
+    if expected != first['frames']:
+        raise ValueError(f'frames [{expected}, {first["frames"]}) are in none of the shards')
+
+
+def iter_shard_frames(metas: List[dict], paths: List[str]):
+    # Frames of all shards in frame order, one at a time
+    for meta, path in sorted(zip(metas, paths), key=lambda item: item[0]['range'][0]):
+        start, stop = meta['range']
+        with zipfile.ZipFile(path) as shard:
+            src = None
+            for k in range(start, stop):
+                if k % meta['step'] != 0:
+                    if src is None:
+                        with shard.open('source.npy') as f:
+                            src = np.lib.format.read_array(f)
+                    yield src
+                    continue
+                with shard.open(f'frame_{k:06d}.npy') as f:
+                    yield np.lib.format.read_array(f)
+
+
+def merge_shards(paths: List[str], out_path: str, duration: int = 200, loop: int = 0):
+    """
+     Checks that the shards make up one whole animation and writes it to out_path (.gif or .png)
+    """
+    metas = [read_meta(path) for path in paths]
+    check_shards(metas, paths)
+    palette = None
+    if not out_path.lower().endswith(('.png', '.apng')):
+        # One palette from the source for all frames, like main.render_gif
+        with zipfile.ZipFile(paths[0]) as shard, shard.open('source.npy') as f:
+            palette = np.lib.format.read_array(f)
+    write_frames(iter_shard_frames(metas, paths), out_path, duration=duration, loop=loop, palette=palette)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Render an animation in frame range shards and merge them')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    plan = commands.add_parser('plan', help='print the frame ranges of a number of shards')
+    plan.add_argument('--frames', type=int, required=True)
+    plan.add_argument('--shards', type=int, required=True)
+
+    render = commands.add_parser('render', help='render a frame range into a shard file')
+    render.add_argument('source', help='image to glitch')
+    render.add_argument('-o', '--output', required=True, help='shard file to write (.npz)')
+    render.add_argument('--seed', type=int, required=True, help='same seed on every node')
+    render.add_argument('--frames', type=int, default=23, help='frames of the whole animation')
+    render.add_argument('--step', type=int, default=1, help='glitch every step\'th frame')
+    render.add_argument('--frame-range', default=':', help='START:STOP of the frames to render (default: all)')
+    render.add_argument('-e', '--effects', type=int, nargs='+', default=[10], help='effect indices, in order')
+    render.add_argument('--noise-tiles', type=int, default=0, help='noise tile pool size, 0 for exact noise')
+    render.add_argument('--threads', type=int, default=1, help='threads every frame is rendered with')
+
+    merge = commands.add_parser('merge', help='assemble shards into the final GIF or APNG')
+    merge.add_argument('shards', nargs='+', help='shard files, in any order')
+    merge.add_argument('-o', '--output', required=True, help='.gif, or .png for an APNG')
+    merge.add_argument('--duration', type=int, default=200, help='milliseconds per frame')
+    merge.add_argument('--loop', type=int, default=0, help='0 loops forever')
+
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'plan':
+            for start, stop in plan_shards(args.frames, args.shards):
+                print(f'{start}:{stop}')
+        elif args.command == 'render':
+            if args.frames < 1 or args.step < 1:
+                raise ValueError('frames and step must be positive integers')
+            render_shard(args.source, args.output, args.seed, args.frames,
+                         parse_frame_range(args.frame_range, args.frames), tuple(args.effects),
+                         args.step, args.noise_tiles, args.threads)
+        else:
+            merge_shards(args.shards, args.output, args.duration, args.loop)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
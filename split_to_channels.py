@@ -1,29 +1,130 @@
+# Splits images into their channels
+# Every image is decoded once, R, G and B come out as RGB images with the other channels
+# zeroed, HSV and YCbCr channels as grayscale images
+#   python split_to_channels.py pics -o result --hsv --ycbcr -j 4
+import argparse
 import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional, Sequence
+
 import numpy as np
 # Pillow is the friendly fork of PIL (the Python Imaging Library).
-from PIL import Image, ImageSequence
+from PIL import Image
+
+# Output suffix of every channel of a color space, in channel order
+CHANNELS = {
+    'rgb': ('red', 'green', 'blue'),
+    'hsv': ('hue', 'saturation', 'value'),
+    'ycbcr': ('y', 'cb', 'cr'),
+}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def split_channels(img: Image.Image, spaces: Sequence[str] = ('rgb',)) -> Dict[str, Image.Image]:
+    """
+     Returns {channel name: Image} of every channel of the given color spaces
+     RGB channels keep their color and the alpha of the source, the other channels are zeroed
+     HSV and YCbCr channels are single band (L) images
+    """
+    unknown = set(spaces) - set(CHANNELS)
+    if unknown:
+        raise ValueError(f'Unknown color spaces {sorted(unknown)}, must be in {list(CHANNELS)}')
+    alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    rgb = img.convert('RGBA' if alpha else 'RGB')
+
+    channels = {}
+    if 'rgb' in spaces:
+        arr = np.asarray(rgb)
+        for c, name in enumerate(CHANNELS['rgb']):
+            # One zeroed image per channel with only that channel (and alpha) copied in
+            out = np.zeros_like(arr)
+            out[..., c] = arr[..., c]
+            if alpha:
+                out[..., 3] = arr[..., 3]
+            channels[name] = Image.fromarray(out, rgb.mode)
+    for space in ('hsv', 'ycbcr'):
+        if space in spaces:
+            converted = rgb.convert('RGB').convert('HSV' if space == 'hsv' else 'YCbCr')
+            channels.update(zip(CHANNELS[space], converted.split()))
+    return channels
+
+
+def split_file(src_path: str, out_dir: str, spaces: Sequence[str] = ('rgb',), compress_level: int = 6) -> List[str]:
+    """
+     Decodes src_path once and writes <name>_<channel>.png into out_dir for every channel
+     Returns the written paths
+    """
+    name = os.path.basename(src_path).split('.')[0]
+    with Image.open(src_path) as img:
+        channels = split_channels(img, spaces)
+    paths = []
+    for channel, channel_img in channels.items():
+        path = os.path.join(out_dir, name + '_' + channel + '.png')
+        channel_img.save(path, compress_level=compress_level)
+        paths.append(path)
+    return paths
+
+
+def iter_sources(paths: Iterable[str]):
+    # Files as given, directories expanded to the images in them
+    for path in paths:
+        if os.path.isdir(path):
+            for f in sorted(os.listdir(path)):
+                if f.lower().endswith(IMAGE_EXTENSIONS) and not f.startswith('.'):
+                    yield os.path.join(path, f)
+        else:
+            yield path
+
+
+def _report_done(done, done_count) -> int:
+    for i, future in enumerate(done, done_count + 1):
+        print('[%d] saved' % i, ', '.join(future.result()))
+    return len(done)
 
-img_name = 'USC_dornsife.jpg'
-img = Image.open(os.path.join('pics', img_name))
-assert(isinstance(img, Image.Image))
 
-arr = np.array(img)
+def split_all(paths: Iterable[str], out_dir: str = 'result', spaces: Sequence[str] = ('rgb',),
+              max_workers: Optional[int] = None, compress_level: int = 6):
+    """
+     Splits every image of paths (files or directories) on at most max_workers processes
+     (defaults to the number of cores)
+     At most two images per worker are queued at a time, so memory stays bounded however
+     many images there are
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    max_workers = max_workers or os.cpu_count() or 1
+    sources = iter_sources(paths)
+    done_count = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = set()
+        for src_path in sources:
+            pending.add(pool.submit(split_file, src_path, out_dir, spaces, compress_level))
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                done_count += _report_done(done, done_count)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            done_count += _report_done(done, done_count)
 
-arr_r = arr.copy()
-arr_g = arr.copy()
-arr_b = arr.copy()
 
-for y in range(img.height):
-    for x in range(img.width):
-        arr_r[y][x][1] = 0
-        arr_r[y][x][2] = 0
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split images into their color channels')
+    parser.add_argument('inputs', nargs='*', default=[os.path.join('pics', 'USC_dornsife.jpg')],
+                        help='Image files or directories of images (default: pics/USC_dornsife.jpg)')
+    parser.add_argument('-o', '--out-dir', default='result')
+    parser.add_argument('--hsv', action='store_true', help='Also write the hue, saturation and value channels')
+    parser.add_argument('--ycbcr', action='store_true', help='Also write the Y, Cb and Cr channels')
+    parser.add_argument('--no-rgb', action='store_true', help='Skip the red, green and blue channels')
+    parser.add_argument('-j', '--jobs', type=int, help='Worker processes, defaults to the number of cores')
+    parser.add_argument('--compress-level', type=int, default=6, choices=range(10), metavar='[0-9]',
+                        help='PNG compression, lower is faster (default: %(default)s)')
+    args = parser.parse_args(argv)
 
-        arr_g[y][x][0] = 0
-        arr_g[y][x][2] = 0
+    spaces = [space for space, wanted in (('rgb', not args.no_rgb), ('hsv', args.hsv), ('ycbcr', args.ycbcr))
+              if wanted]
+    if not spaces:
+        parser.error('nothing to write, --no-rgb needs --hsv or --ycbcr')
+    split_all(args.inputs, args.out_dir, spaces, args.jobs, args.compress_level)
 
-        arr_b[y][x][0] = 0
-        arr_b[y][x][1] = 0
 
-Image.fromarray(arr_r).save('result/' + img_name.split('.')[0] + '_red.png')
-Image.fromarray(arr_g).save('result/' + img_name.split('.')[0] + '_green.png')
-Image.fromarray(arr_b).save('result/' + img_name.split('.')[0] + '_blue.png')
+if __name__ == '__main__':
+    main()
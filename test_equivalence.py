@@ -0,0 +1,193 @@
+# Checks that the faster ways of rendering give the same pixels as a plain serial render,
+# and that the arrays they render into are checked
+#   python -m pytest -q test_equivalence.py
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from frame_writer import GifWriter, write_frames
+from glitch_effect import EFFECT_NAMES, ImageGlitcher
+from glitch_stats import GlitchStats
+from shard_render import merge_shards, plan_shards, render_shard
+
+SEED = 580
+# Every effect on its own, and chains mixing remap, band and block effects
+EFFECT_SEQS = [(i,) for i in range(len(EFFECT_NAMES))] + [(0, 1, 10), (8, 2, 9, 6), (3, 4, 5, 7)]
+
+
+def synthetic_image(height=301, width=83, channels=3):
+    # Odd sizes, so bands and blocks do not line up with the image edges, and tall enough
+    # to be split into bands by threads
+    return np.random.RandomState(0).randint(0, 256, (height, width, channels), dtype=np.uint8)
+
+
+def frame_arrays(frames):
+    return [np.asarray(frame) for frame in frames]
+
+
+def band_threads() -> int:
+    # Threads of the band thread pools, they are only started when a frame is split into bands
+    return sum(thread.name.startswith('glitch_band') for thread in threading.enumerate())
+
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+@pytest.mark.parametrize('glitcher_params', [{}, {'threads': 2}, {'stats': GlitchStats()}])
+def test_workers_match_serial(start_method, glitcher_params):
+    if start_method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f'no {start_method} start method on this platform')
+    src = Image.fromarray(synthetic_image())
+    params = dict(seed=SEED, gif=True, frames=6, step=2, effect_type_seq=(0, 1, 10, 8))
+    serial = frame_arrays(ImageGlitcher().glitch_image(src, **params))
+
+    glitcher = ImageGlitcher(**glitcher_params)
+    # A glitcher that already rendered, with its thread pool and stats, must still start workers
+    threads = band_threads()
+    glitcher.glitch_image(src, seed=SEED, effect_type_seq=(1, 10))
+    assert (band_threads() > threads) == ('threads' in glitcher_params)
+    previous = multiprocessing.get_start_method()
+    multiprocessing.set_start_method(start_method, force=True)
+    try:
+        pooled = frame_arrays(glitcher.glitch_image(src, workers=2, **params))
+    finally:
+        multiprocessing.set_start_method(previous, force=True)
+        glitcher.close()
+    assert len(pooled) == len(serial)
+    for serial_frame, pooled_frame in zip(serial, pooled):
+        np.testing.assert_array_equal(serial_frame, pooled_frame)
+
+
+@pytest.mark.parametrize('effect_type_seq', EFFECT_SEQS)
+def test_threads_match_serial(effect_type_seq):
+    src = synthetic_image(channels=4)
+    serial = ImageGlitcher().glitch_array(src, frame_index=3, effect_type_seq=effect_type_seq, seed=SEED).copy()
+    glitcher = ImageGlitcher(threads=3)
+    threads = band_threads()
+    threaded = glitcher.glitch_array(src, frame_index=3, effect_type_seq=effect_type_seq, seed=SEED)
+    assert band_threads() > threads
+    glitcher.close()
+    np.testing.assert_array_equal(serial, threaded)
+
+
+@pytest.mark.parametrize('effect_type_seq', EFFECT_SEQS)
+def test_tiled_matches_array(effect_type_seq):
+    src = synthetic_image()
+    whole = ImageGlitcher().glitch_array(src, frame_index=2, effect_type_seq=effect_type_seq, seed=SEED).copy()
+    out = np.zeros_like(src)
+    ImageGlitcher().glitch_tiled(src, out, seed=SEED, frame_index=2, effect_type_seq=effect_type_seq, band_rows=64)
+    np.testing.assert_array_equal(whole, out)
+
+
+def test_array_out_is_checked():
+    src = synthetic_image()
+    out = np.zeros_like(src)
+    assert ImageGlitcher().glitch_array(src, effect_type_seq=(1,), seed=SEED, out=out) is out
+    for out in (np.zeros((src.shape[1], src.shape[0], 3), dtype=np.uint8), np.zeros(src.shape, dtype=np.float32),
+                np.zeros_like(src, order='F')):
+        with pytest.raises(ValueError):
+            ImageGlitcher().glitch_array(src, effect_type_seq=(1,), seed=SEED, out=out)
+
+
+def test_frames_array_out_is_checked():
+    with pytest.raises(ValueError):
+        ImageGlitcher().glitch_frames_array(synthetic_image(), seed=SEED, frames=2, effect_type_seq=(1,),
+                                            out=np.zeros((2, 301, 83, 3), dtype=np.uint8, order='F'))
+
+
+def test_tiled_out_is_checked():
+    src = synthetic_image()
+    for out in (np.zeros((src.shape[1], src.shape[0], 3), dtype=np.uint8), np.zeros_like(src, order='F')):
+        with pytest.raises(ValueError):
+            ImageGlitcher().glitch_tiled(src, out, seed=SEED, effect_type_seq=(1,))
+
+
+def test_gif_keeps_transparency():
+    frames = []
+    for k in range(3):
+        pixels = synthetic_image(channels=4)
+        pixels[..., 3] = 255
+        pixels[:10 + 5 * k, :, 3] = 0
+        frames.append(Image.fromarray(pixels, 'RGBA'))
+    buffer = io.BytesIO()
+    with GifWriter(buffer) as writer:
+        for frame in frames:
+            writer.write(frame)
+
+    gif = Image.open(io.BytesIO(buffer.getvalue()))
+    for k, frame in enumerate(frames):
+        gif.seek(k)
+        np.testing.assert_array_equal(np.asarray(gif.convert('RGBA'))[..., 3] == 0,
+                                      np.asarray(frame)[..., 3] == 0)
+
+
+def gif_image(transparency=None) -> Image.Image:
+    # Single frame palette GIF, decoded the way Image.open hands it over
+    palette_image = Image.fromarray(synthetic_image()).quantize(64)
+    buffer = io.BytesIO()
+    if transparency is None:
+        palette_image.save(buffer, format='GIF')
+    else:
+        palette_image.save(buffer, format='GIF', transparency=transparency)
+    buffer.seek(0)
+    return Image.open(buffer)
+
+
+@pytest.mark.parametrize('transparency, mode', [(None, 'RGB'), (3, 'RGBA')])
+def test_gif_image_blocks(transparency, mode):
+    for effect_type_seq in ((6,), (7,)):
+        glitched = ImageGlitcher().glitch_image(gif_image(transparency), seed=SEED, effect_type_seq=effect_type_seq)
+        assert glitched.mode == mode
+
+
+@pytest.mark.parametrize('transparency, mode', [(None, 'RGB'), (3, 'RGBA')])
+def test_gif_image_color_block(transparency, mode):
+    glitched = ImageGlitcher().glitch_image(gif_image(transparency), seed=SEED, effect_type_seq=(10,))
+    assert glitched.mode == mode
+
+
+def test_glitchers_in_threads_match_serial():
+    src = synthetic_image()
+    effect_type_seq = (8, 9, 2, 6, 10)
+    serial = ImageGlitcher().glitch_array(src, 0, effect_type_seq, seed=11).copy()
+
+    def render(_):
+        # One glitcher per thread, each renders the same seeded frame again and again
+        glitcher = ImageGlitcher()
+        return [glitcher.glitch_array(src, 0, effect_type_seq, seed=11).copy() for _ in range(20)]
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for renders in pool.map(render, range(4)):
+            for rendered in renders:
+                np.testing.assert_array_equal(serial, rendered)
+
+
+def test_shards_merge_to_direct_render(tmp_path):
+    src = synthetic_image()
+    src_path = str(tmp_path / 'source.png')
+    Image.fromarray(src).save(src_path)
+    frames, step, effect_type_seq = 9, 2, (10, 1)
+
+    shard_paths = []
+    for k, frame_range in enumerate(plan_shards(frames, 3)):
+        shard_paths.append(str(tmp_path / f'shard_{k}.npz'))
+        render_shard(src_path, shard_paths[-1], SEED, frames, frame_range, effect_type_seq, step)
+    merged = str(tmp_path / 'merged.gif')
+    merge_shards(shard_paths[::-1], merged)
+
+    direct = str(tmp_path / 'direct.gif')
+    write_frames(ImageGlitcher().glitch_frames_array(src, seed=SEED, frames=frames, step=step,
+                                                     effect_type_seq=effect_type_seq),
+                 direct, palette=src)
+    with open(merged, 'rb') as f, open(direct, 'rb') as g:
+        assert f.read() == g.read()
+
+
+def test_plan_covers_all_frames():
+    assert plan_shards(10, 3) == [(0, 3), (3, 6), (6, 10)]
+    assert plan_shards(2, 5) == [(0, 1), (1, 2)]
+    with pytest.raises(ValueError):
+        plan_shards(10, 0)
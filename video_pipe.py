@@ -0,0 +1,318 @@
+# Glitches a raw video stream inline, e.g. between two ffmpeg processes
+#
+#   ffmpeg -i in.mp4 -f rawvideo -pix_fmt rgb24 - |
+#       python video_pipe.py --size 1920x1080 -e 1 5 8 |
+#       ffmpeg -f rawvideo -pix_fmt rgb24 -s 1920x1080 -r 30 -i - out.mp4
+#
+#   ffmpeg -i in.mp4 -f yuv4mpegpipe - | python video_pipe.py -e 1 5 8 | ffplay -
+#
+# Frames are read straight into a reused buffer, glitched as ndarrays and written
+# straight from the glitcher's buffers, there is no PIL or disk round trip
+
+import argparse
+import random
+import sys
+import time
+from typing import BinaryIO, Optional, TextIO
+
+import numpy as np
+
+from glitch_effect import ImageGlitcher
+
+Y4M_MAGIC = b'YUV4MPEG2'
+# 8 bit 4:2:0 colorspaces of Y4M, they only differ in where chroma is sited
+Y4M_420 = ('420jpeg', '420paldv', '420mpeg2', '420')
+
+
+def read_exactly(fp: BinaryIO, buf: memoryview) -> bool:
+    """
+     Fills buf from fp, pipes may return less than asked for
+     Returns False at a clean end of stream, raises on a truncated frame
+    """
+    filled = 0
+    while filled < len(buf):
+        n = fp.readinto(buf[filled:])
+        if not n:
+            if filled == 0:
+                return False
+            raise EOFError(f'Truncated frame, {filled} of {len(buf)} bytes')
+        filled += n
+    return True
+
+
+class RawVideoReader:
+    """
+     Fixed size rgb24 (or rgba) frames back to back, like ffmpeg -f rawvideo writes them
+    """
+
+    def __init__(self, fp: BinaryIO, width: int, height: int, channels: int = 3, prefix: bytes = b''):
+        self.fp = fp
+        self.width, self.height = width, height
+        self.frame = np.empty((height, width, channels), dtype=np.uint8)
+        # Bytes that were already read from fp while sniffing the format
+        self.prefix = prefix
+
+    def read(self) -> Optional[np.ndarray]:
+        buf = memoryview(self.frame).cast('B')
+        if self.prefix:
+            n = min(len(self.prefix), len(buf))
+            buf[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            if not read_exactly(self.fp, buf[n:]) and n < len(buf):
+                raise EOFError(f'Truncated frame, {n} of {len(buf)} bytes')
+            return self.frame
+        return self.frame if read_exactly(self.fp, buf) else None
+
+
+class RawVideoWriter:
+
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+
+    def write(self, frame: np.ndarray):
+        self.fp.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+
+
+class Y4MReader:
+    """
+     YUV4MPEG2 stream with 4:2:0, 4:4:4 or mono 8 bit frames
+     Frames are converted to RGB (BT.601, limited range) into a reused buffer
+    """
+
+    def __init__(self, fp: BinaryIO, header: bytes):
+        self.fp = fp
+        self.header = header
+        params = {token[:1]: token[1:] for token in header.split()[1:]}
+        self.width, self.height = int(params[b'W']), int(params[b'H'])
+        self.colorspace = params.get(b'C', b'420jpeg').decode()
+        if self.colorspace in Y4M_420:
+            if self.width % 2 or self.height % 2:
+                raise ValueError('4:2:0 frames must have an even width and height')
+            chroma = (self.height // 2, self.width // 2)
+        elif self.colorspace == '444':
+            chroma = (self.height, self.width)
+        elif self.colorspace == 'mono':
+            chroma = (0, 0)
+        else:
+            # e.g. C420p10, more than 8 bits per sample
+            raise ValueError(f'Unsupported Y4M colorspace C{self.colorspace}, use 8 bit 420, 444 or mono')
+
+        luma_size = self.width * self.height
+        chroma_size = chroma[0] * chroma[1]
+        self.planes = np.empty(luma_size + 2 * chroma_size, dtype=np.uint8)
+        self.y = self.planes[:luma_size].reshape(self.height, self.width)
+        self.u = self.planes[luma_size:luma_size + chroma_size].reshape(chroma)
+        self.v = self.planes[luma_size + chroma_size:].reshape(chroma)
+        self.frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.converter = YuvConverter(self.height, self.width, self.colorspace)
+
+    @classmethod
+    def open(cls, fp: BinaryIO, prefix: bytes = b''):
+        header = prefix + fp.readline()
+        if not header.startswith(Y4M_MAGIC):
+            raise ValueError('Not a YUV4MPEG2 stream')
+        return cls(fp, header.rstrip(b'\n'))
+
+    def read(self) -> Optional[np.ndarray]:
+        # Every frame starts with a FRAME line, its optional parameters are ignored
+        line = self.fp.readline()
+        if not line:
+            return None
+        if not line.startswith(b'FRAME'):
+            raise ValueError('Corrupt Y4M stream, expected a FRAME header')
+        if not read_exactly(self.fp, memoryview(self.planes)):
+            raise EOFError('Truncated Y4M frame')
+        self.converter.to_rgb(self.y, self.u, self.v, self.frame)
+        return self.frame
+
+
+class Y4MWriter:
+    """
+     Writes RGB frames as a YUV4MPEG2 stream with the header of the input stream
+    """
+
+    def __init__(self, fp: BinaryIO, reader: Y4MReader):
+        self.fp = fp
+        self.reader = reader
+        self.planes = np.empty_like(reader.planes)
+        luma_size = reader.y.size
+        chroma_size = reader.u.size
+        self.y = self.planes[:luma_size].reshape(reader.y.shape)
+        self.u = self.planes[luma_size:luma_size + chroma_size].reshape(reader.u.shape)
+        self.v = self.planes[luma_size + chroma_size:].reshape(reader.v.shape)
+        fp.write(reader.header + b'\n')
+
+    def write(self, frame: np.ndarray):
+        self.reader.converter.to_yuv(frame, self.y, self.u, self.v)
+        self.fp.write(b'FRAME\n')
+        self.fp.write(memoryview(self.planes))
+
+
+class YuvConverter:
+    """
+     BT.601 limited range conversion between 8 bit YUV planes and RGB pixels
+     The chroma terms of 4:2:0 frames are computed at chroma resolution and broadcast
+     over each 2x2 block, all the float work happens in buffers allocated once
+    """
+
+    def __init__(self, height: int, width: int, colorspace: str):
+        self.subsampled = colorspace in Y4M_420
+        self.mono = colorspace == 'mono'
+        self.luma = np.empty((height, width), dtype=np.float32)
+        self.channel = np.empty((height, width), dtype=np.float32)
+        chroma = (height // 2, width // 2) if self.subsampled else (height, width)
+        self.d = np.empty(chroma, dtype=np.float32)
+        self.e = np.empty(chroma, dtype=np.float32)
+        self.term = np.empty(chroma, dtype=np.float32)
+        self.block_sum = np.empty((*chroma, 3), dtype=np.uint16)
+
+    def __blocks(self, arr: np.ndarray) -> np.ndarray:
+        # 2x2 blocks of a full resolution plane, lined up with the chroma samples
+        if not self.subsampled:
+            return arr
+        height, width = arr.shape[:2]
+        return arr.reshape(height // 2, 2, width // 2, 2, *arr.shape[2:])
+
+    def __chroma(self, term: np.ndarray) -> np.ndarray:
+        # Chroma term broadcast against __blocks of a full resolution plane
+        return term[:, None, :, None] if self.subsampled else term
+
+    def to_rgb(self, y: np.ndarray, u: np.ndarray, v: np.ndarray, out: np.ndarray):
+        np.subtract(y, 16, out=self.luma, dtype=np.float32)
+        self.luma *= 1.164
+        # Rounds instead of truncating when the channels are cast back to uint8
+        self.luma += 0.5
+        if self.mono:
+            np.clip(self.luma, 0, 255, out=self.luma)
+            out[...] = self.luma[..., None]
+            return
+
+        np.subtract(u, 128, out=self.d, dtype=np.float32)
+        np.subtract(v, 128, out=self.e, dtype=np.float32)
+        luma = self.__blocks(self.luma)
+        channel = self.__blocks(self.channel)
+        for c, (kd, ke) in enumerate(((0, 1.596), (-0.392, -0.813), (2.017, 0))):
+            np.multiply(self.d, kd, out=self.term)
+            self.term += ke * self.e
+            np.add(luma, self.__chroma(self.term), out=channel)
+            np.clip(self.channel, 0, 255, out=self.channel)
+            out[..., c] = self.channel
+
+    def to_yuv(self, rgb: np.ndarray, y: np.ndarray, u: np.ndarray, v: np.ndarray):
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        np.multiply(r, 0.257, out=self.luma, dtype=np.float32)
+        self.luma += 0.504 * g.astype(np.float32)
+        self.luma += 0.098 * b.astype(np.float32)
+        self.luma += 16.5
+        y[...] = self.luma
+        if self.mono:
+            return
+
+        # Chroma from the mean color of each block, summed from the four strided
+        # sub-images which is much faster than mean() over the block axes
+        if self.subsampled:
+            block_sum = self.block_sum
+            np.add(rgb[0::2, 0::2, :3], rgb[0::2, 1::2, :3], out=block_sum, dtype=np.uint16)
+            block_sum += rgb[1::2, 0::2, :3]
+            block_sum += rgb[1::2, 1::2, :3]
+            scale = 0.25
+        else:
+            block_sum = rgb
+            scale = 1
+        r, g, b = block_sum[..., 0], block_sum[..., 1], block_sum[..., 2]
+        for plane, (kr, kg, kb) in ((u, (-0.148, -0.291, 0.439)), (v, (0.439, -0.368, -0.071))):
+            np.multiply(r, kr * scale, out=self.term, dtype=np.float32)
+            self.term += (kg * scale) * g.astype(np.float32)
+            self.term += (kb * scale) * b.astype(np.float32)
+            self.term += 128.5
+            np.clip(self.term, 0, 255, out=self.term)
+            plane[...] = self.term
+
+
+def open_stream(fp: BinaryIO, size: Optional[str], channels: int = 3):
+    """
+     Returns a reader for fp, Y4M streams are recognized by their magic,
+     anything else is raw video and needs the frame size as WIDTHxHEIGHT
+    """
+    prefix = fp.read(len(Y4M_MAGIC))
+    if prefix == Y4M_MAGIC:
+        return Y4MReader.open(fp, prefix)
+    if size is None:
+        raise ValueError('--size WIDTHxHEIGHT is required for rawvideo input')
+    width, height = (int(n) for n in size.lower().split('x'))
+    return RawVideoReader(fp, width, height, channels, prefix)
+
+
+def run(reader, writer, glitcher: ImageGlitcher, effect_type_seq, seed=None,
+        report_every: float = 2.0, log: TextIO = sys.stderr) -> float:
+    """
+     Glitches every frame of reader into writer and returns the sustained frames per second
+     Throughput is reported to log every report_every seconds
+    """
+    if not seed:
+        # One base seed for the whole stream, the frames still differ by their index
+        # A seed of 0 is no seed to the glitcher, which would draw a new one for every frame
+        seed = random.SystemRandom().getrandbits(64)
+    frames = 0
+    start = last_report = time.perf_counter()
+    last_frames = 0
+    while True:
+        frame = reader.read()
+        if frame is None:
+            break
+        writer.write(glitcher.glitch_array(frame, frames, effect_type_seq, seed=seed))
+        frames += 1
+
+        now = time.perf_counter()
+        if report_every and now - last_report >= report_every:
+            print(f'{frames} frames, {(frames - last_frames) / (now - last_report):.1f} fps',
+                  file=log, flush=True)
+            last_report, last_frames = now, frames
+
+    elapsed = time.perf_counter() - start
+    fps = frames / elapsed if elapsed else 0.0
+    print(f'{frames} frames in {elapsed:.2f} s, {fps:.1f} fps', file=log, flush=True)
+    return fps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Glitch a rawvideo or Y4M stream from stdin to stdout')
+    parser.add_argument('-e', '--effects', type=int, nargs='+', default=[1],
+                        help='effect indices of ImageGlitcher.effects, applied in order')
+    parser.add_argument('-s', '--size', help='WIDTHxHEIGHT of rawvideo input')
+    parser.add_argument('--rgba', action='store_true', help='rawvideo input is rgba instead of rgb24')
+    parser.add_argument('--seed', type=int, help='non-zero seed, makes the output reproducible')
+    parser.add_argument('--noise-tiles', type=int, default=0,
+                        help='sample analog noise from a pool of this many pre-generated tiles')
+    parser.add_argument('--raw-out', action='store_true', help='write rawvideo even for Y4M input')
+    parser.add_argument('-i', '--input', default='-', help='input file, defaults to stdin')
+    parser.add_argument('-o', '--output', default='-', help='output file, defaults to stdout')
+    parser.add_argument('--report', type=float, default=2.0, help='seconds between fps reports, 0 for none')
+    args = parser.parse_args(argv)
+
+    for i in args.effects:
+        if not 0 <= i < 11:
+            parser.error(f'unknown effect {i}')
+    if args.seed == 0:
+        parser.error('--seed must not be 0, which stands for no seed')
+
+    src = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    dst = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        reader = open_stream(src, args.size, 4 if args.rgba else 3)
+        if isinstance(reader, Y4MReader) and not args.raw_out:
+            writer = Y4MWriter(dst, reader)
+        else:
+            writer = RawVideoWriter(dst)
+        run(reader, writer, ImageGlitcher(noise_tiles=args.noise_tiles), tuple(args.effects),
+            args.seed, args.report)
+    finally:
+        dst.flush()
+        if src is not sys.stdin.buffer:
+            src.close()
+        if dst is not sys.stdout.buffer:
+            dst.close()
+
+
+if __name__ == '__main__':
+    main()